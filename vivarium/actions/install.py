@@ -2,6 +2,7 @@ from copy import deepcopy
 import os.path
 import stat
 import string
+import threading
 
 from vivarium.vivarium import File
 from vivarium.vivarium import Action
@@ -15,6 +16,42 @@ class Install(Action):
     def __init__(self, *args, **kwargs):
         super(Install, self).__init__(*args, **kwargs)
         self._dir = None
+        self._downloaded = {}
+        self._installed = {}
+        self._batch = None
+
+    @classmethod
+    def prepare(cls, es, steps):
+        """
+        Download the packages from every step in the stage with one
+        call rather than one call per package.
+
+        Installs still happen as each step is planted so they land
+        after the steps before them, say a preseed file. Only the
+        first step of a target has nothing before it, so the packages
+        of those steps are installed together by whichever of them is
+        planted first.
+        """
+        packages = []
+        for step in steps:
+            for package in step.parameters.get('packages', []):
+                if package not in packages:
+                    packages.append(package)
+        if not packages:
+            return
+        print("Install: preparing {0} packages".format(len(packages)))
+        downloaded = es.download_packages(packages)
+        leading = [step for step in steps if step.number == 0
+                   and step.parameters.keys() == ['packages']]
+        batch = _PackageBatch([])
+        for step in leading:
+            for package in step.parameters['packages']:
+                if package not in batch.packages:
+                    batch.packages.append(package)
+        for step in steps:
+            step.action_impl._downloaded = dict(downloaded)
+        for step in leading:
+            step.action_impl._batch = batch
 
     def gather(self, source, parameters, env):
         rv = {}
@@ -35,9 +72,11 @@ class Install(Action):
     def plant(self, ctxt):
         print("Install: planting step {0}".format(ctxt.number))
         fnmap = self._mk_fn_map('plant')
+        complete = True
         for key, value in ctxt.params.iteritems():
-            fnmap[key](value, ctxt)
-        return True
+            if fnmap[key](value, ctxt) is False:
+                complete = False
+        return complete
 
     def reap(self, ctxt):
         print("Install: reaping step {0}".format(ctxt.number))
@@ -75,6 +114,7 @@ class Install(Action):
             filespec = ctxt.data['files'][file_def]
             # print("_sow_files: {0} - {1}".format(file_def, filespec))
             vvfile = File().from_seed(filespec)
+            vvfile.check_owners(ctxt)
             filename = self._working_filename(file_def)
             vvfile.sow(filename, ctxt)
 
@@ -85,32 +125,60 @@ class Install(Action):
             src_filename = self._working_filename(file_def)
             dst_filename = filespec['location']
             # print("PLANTFILES: {0} {1}".format(src_filename,dst_filename))
-            vvfile.plant(src_filename, dst_filename, ctxt)
+            changed, unchanged = vvfile.plant(src_filename, dst_filename, ctxt)
+            stats = ctxt.stats
+            stats['files_changed'] = stats.get('files_changed', 0) + changed
+            stats['files_unchanged'] = \
+                stats.get('files_unchanged', 0) + unchanged
 
     def _reap_files(self, files, ctxt):
         # *TODO: clean up intermediary files and directories.
         pass
 
     def _sow_packages(self, packages, ctxt):
-        for package in packages:
-            # in a chroot, a lot of the package installs fail because
-            # start/stop fails. Not sure how to resolve
-            # this. 2010-12-11 Aaron
-            # if not ctxt.es.download_package(package):
-            #     msg = "Unable to fetch package: {0}"
-            #     raise RuntimeError, msg.format(package)
-            ctxt.es.download_package(package)
+        # in a chroot, a lot of the package installs fail because
+        # start/stop fails. Not sure how to resolve
+        # this. 2010-12-11 Aaron
+        # Failures are reported rather than raised for now.
+        remaining = [pkg for pkg in packages if pkg not in self._downloaded]
+        if remaining:
+            self._downloaded.update(ctxt.es.download_packages(remaining))
+        Install._report("fetch", packages, self._downloaded)
 
     def _plant_packages(self, packages, ctxt):
+        if self._batch is not None:
+            self._installed.update(self._batch.install(ctxt.es))
+        remaining = [pkg for pkg in packages if pkg not in self._installed]
+        if remaining:
+            self._installed.update(ctxt.es.install_packages(remaining))
+        return Install._report("install", packages, self._installed)
+
+    @staticmethod
+    def _report(verb, packages, results):
+        "Print each package which failed. Returns False if any did."
+        complete = True
         for package in packages:
-            # in a chroot, a lot of the package installs fail because
-            # start/stop fails. Not sure how to resolve
-            # this. 2010-12-11 Aaron
-            # if not ctxt.es.install_package(package):
-            #     msg = "Unable to install package: {0}"
-            #     raise RuntimeError, msg.format(package)
-            ctxt.es.install_package(package)
+            if not results.get(package, False):
+                print("Unable to {0} package: {1}".format(verb, package))
+                complete = False
+        return complete
 
     def _reap_packages(self, packages, ctxt):
         # *TODO: remove the package archive
         pass
+
+class _PackageBatch(object):
+    """
+    Packages from several steps of a stage which are installed with
+    one call by whichever of those steps is planted first.
+    """
+    def __init__(self, packages):
+        self.packages = packages
+        self._installed = None
+        self._lock = threading.Lock()
+
+    def install(self, es):
+        with self._lock:
+            if self._installed is None:
+                self._installed = es.install_packages(self.packages)
+        return self._installed
@@ -2,26 +2,17 @@ import errno
 import os
 import platform
 import subprocess
+import threading
 
 from vivarium.vivarium import Environment
+from vivarium.vivarium import JailWorker
+
+# Only one package manager may run at a time.
+_package_lock = threading.Lock()
 
 def register(environments):
     environments['debian'] = Debian
 
-def jailed(worker):
-    def in_jail(*args,**kwargs):
-        if args[0].root != '/':
-            real_root = os.open('/', os.O_RDONLY)
-            os.chroot(args[0].root)
-        try:
-            worker(*args,**kwargs)
-        finally:
-            if args[0].root != '/':
-                os.fchdir(real_root)
-                os.chroot(".")
-                os.close(real_root)
-    return in_jail
-
 class Debian(Environment):
     """
     An instance of this class represents installing into a debian
@@ -45,12 +36,22 @@ class Debian(Environment):
     mirror
       What mirror to use for downloading packages when configuring a
       non-root host.
+
+    Work for a non-root host is done by a JailWorker which chroots
+    into the host once, started when the host is bootstrapped. It has
+    a child for each of the ``--jobs`` plant threads so one long
+    command does not hold up the work of other targets.
     """
     def __init__(self, *args, **kwargs):
         super(Debian, self).__init__(*args, **kwargs)
         self.debargs = {}
         if hasattr(self.args, 'debian'):
             self.debargs = self.args.debian
+        self._worker = None
+        if self.root is not None and self.root != '/':
+            jobs = getattr(self.args, 'jobs', 1) or 1
+            self._worker = JailWorker(
+                self.root, {'owners': self.owners}, size=jobs)
 
     def is_viable(self):
         # Duck-typing all the way.
@@ -88,22 +89,58 @@ class Debian(Environment):
                 cmd.append(self.debargs['mirror'])
             # print("Bootstrapping: {0}".format(' '.join(cmd)))
             subprocess.call(cmd)
+        # Fork the worker now, before planting starts any threads.
+        self._worker.start()
 
     def download_package(self, package):
         # print("Download: {0}".format(package))
         cmd=['aptitude','install','--download-only', package]
-        return self.run(cmd)
+        with _package_lock:
+            return self.run(cmd)
 
     def install_package(self, package):
         # print("Install: {0}".format(package))
         cmd=['aptitude','install', package]
-        return self.run(cmd)
+        with _package_lock:
+            return self.run(cmd)
+
+    def download_packages(self, packages):
+        return self._batch(['aptitude','install','--download-only'], packages)
+
+    def _install_packages(self, packages):
+        return self._batch(['aptitude','install'], packages)
+
+    def _batch(self, cmd, packages):
+        """
+        Run ``cmd`` once for all of ``packages``. If that fails, run
+        it for each package on its own to find out which ones failed.
+        """
+        packages = list(packages)
+        if not packages:
+            return {}
+        with _package_lock:
+            if self.run(cmd + packages) == 0:
+                return dict((package, True) for package in packages)
+            if len(packages) == 1:
+                return {packages[0]: False}
+            return dict((package, self.run(cmd + [package]) == 0)
+                        for package in packages)
 
-    @jailed
     def run(self, command):
         # print("run: {0}".format(command))
-        return subprocess.call(command)
+        return self.call(command)
 
-    @jailed
     def work(self, fn, *args, **kwargs):
-        return fn(*args, **kwargs)
+        if self._worker is None:
+            return fn(*args, **kwargs)
+        return self._worker.call(fn, *args, **kwargs)
+
+    def work_each(self, fn, *args, **kwargs):
+        if self._worker is None:
+            fn(*args, **kwargs)
+        else:
+            self._worker.broadcast(fn, *args, **kwargs)
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.close()
@@ -0,0 +1,180 @@
+"""
+Strategies for copying a sown file into place.
+
+Each strategy fills a temporary file next to the destination from the
+staged file. The cheapest strategy which works is picked the first
+time a pair of filesystems is seen and then reused for every later
+file between the same two filesystems.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+
+class Unsupported(Exception):
+    """
+    Raised by a strategy which cannot copy between two filesystems.
+    """
+    pass
+
+# errno values which mean the strategy does not work here rather than
+# that the copy itself went wrong.
+_UNSUPPORTED = set([
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    ])
+
+class CopyStrategy(object):
+    name = None
+
+    def place(self, src_filename, temp_filename):
+        """
+        Make ``temp_filename`` hold the content of ``src_filename``.
+        Raises Unsupported if this cannot be done between the two
+        filesystems.
+        """
+        raise NotImplementedError
+
+class Rename(CopyStrategy):
+    """
+    Move the staged file itself. Only possible when the stage and the
+    destination are on the same filesystem, and it consumes the staged
+    file.
+    """
+    name = 'rename'
+
+    def place(self, src_filename, temp_filename):
+        try:
+            os.rename(src_filename, temp_filename)
+        except OSError, e:
+            if e.errno in _UNSUPPORTED:
+                raise Unsupported, str(e)
+            raise
+
+class Reflink(CopyStrategy):
+    """
+    Share the extents of the staged file on copy-on-write filesystems
+    such as btrfs and xfs.
+    """
+    name = 'reflink'
+    FICLONE = 0x40049409
+
+    def place(self, src_filename, temp_filename):
+        with open(src_filename, 'rb') as src:
+            with open(temp_filename, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), Reflink.FICLONE, src.fileno())
+                except IOError, e:
+                    if e.errno in _UNSUPPORTED:
+                        raise Unsupported, str(e)
+                    raise
+
+def _libc_function(name, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fn = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = argtypes
+    fn.restype = ctypes.c_ssize_t
+    return fn
+
+class KernelCopy(CopyStrategy):
+    """
+    Copy in the kernel with ``copy_file_range`` or, where that is
+    missing, ``sendfile`` so the bytes never pass through python.
+    """
+    name = 'kernel'
+    CHUNK = 1 << 30
+    _copy_file_range = _libc_function('copy_file_range', [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint])
+    _sendfile = _libc_function('sendfile', [
+        ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+    def place(self, src_filename, temp_filename):
+        with open(src_filename, 'rb') as src:
+            with open(temp_filename, 'wb') as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                copied = 0
+                while remaining > 0:
+                    count = self._chunk(
+                        src.fileno(), dst.fileno(),
+                        min(remaining, KernelCopy.CHUNK))
+                    if count < 0:
+                        err = ctypes.get_errno()
+                        if copied == 0 and err in _UNSUPPORTED:
+                            raise Unsupported, os.strerror(err)
+                        raise OSError(err, os.strerror(err), temp_filename)
+                    if count == 0:
+                        break
+                    copied += count
+                    remaining -= count
+
+    def _chunk(self, src_fd, dst_fd, count):
+        if KernelCopy._copy_file_range is not None:
+            return KernelCopy._copy_file_range(
+                src_fd, None, dst_fd, None, count, 0)
+        if KernelCopy._sendfile is not None:
+            return KernelCopy._sendfile(dst_fd, src_fd, None, count)
+        ctypes.set_errno(errno.ENOSYS)
+        return -1
+
+class Buffered(CopyStrategy):
+    """
+    Copy through python buffers. Always works.
+    """
+    name = 'buffered'
+
+    def place(self, src_filename, temp_filename):
+        with open(src_filename, 'rb') as src:
+            with open(temp_filename, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+class FileCopier(object):
+    """
+    Process wide chooser of the copy strategy for each pair of
+    filesystems. ``strategies`` is tried in order and may be replaced
+    to add or remove strategies.
+    """
+    __shared_state = {}
+    def __init__(self):
+        self.__dict__ = FileCopier.__shared_state
+        if not hasattr(self, 'strategies'):
+            self.strategies = [Rename(), Reflink(), KernelCopy(), Buffered()]
+            self._chosen = {}
+
+    def place(self, src_filename, temp_filename):
+        """
+        Fill ``temp_filename`` from ``src_filename`` with the first
+        strategy which works between their filesystems. Returns the
+        strategy used.
+        """
+        src_dev = os.stat(src_filename).st_dev
+        dst_dev = os.stat(os.path.dirname(temp_filename) or '.').st_dev
+        key = (src_dev, dst_dev)
+        strategies = self.strategies
+        chosen = self._chosen.get(key, None)
+        if chosen in strategies:
+            strategies = strategies[strategies.index(chosen):]
+        for strategy in strategies:
+            if strategy.name == 'rename' and src_dev != dst_dev:
+                continue
+            try:
+                strategy.place(src_filename, temp_filename)
+            except Unsupported:
+                continue
+            self._chosen[key] = strategy
+            return strategy
+        msg = "No copy strategy for {0}"
+        raise RuntimeError, msg.format(src_filename)
+
+    def reset(self):
+        self._chosen = {}
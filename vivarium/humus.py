@@ -1,27 +1,71 @@
+import contextlib
+import hashlib
 import os.path
 
 import humusfs.yamlfs as yamlfs
+import humusfs.yamlio as yamlio
 import humusfs.fsfs as fsfs
 
 class Humus(object):
-    def __init__(self, location):
+    def __init__(self, location, lazy=False):
         if os.path.isdir(location):
             self._base = fsfs.FSFS(location)
         elif os.path.isfile(location) or location.endswith('.yaml'):
-            self._base = yamlfs.YamlFS(location)
+            self._base = yamlfs.YamlFS(location, lazy=lazy)
         else:
             msg = 'Unable to determine back-end from: {0}'.format(location)
             raise RuntimeError, msg
-        sections = ['content', 'include', 'file', 'presence', 'role']
+        sections = [
+            'content', 'include', 'file', 'presence', 'role', 'blob']
         for section in sections:
             self._setattr_path_to(section)
-        host_sections = ['host', 'seed']
+        host_sections = ['host', 'seed', 'manifest']
         for section in host_sections:
             self._setattr_path_to_host(section)
+        self._trackers = []
 
     def open(self, filename, mode='r'):
         return self._base.open(filename, mode)
 
+    def read(self, filename):
+        with self.open(filename) as fl:
+            content = fl.read()
+        if self._trackers:
+            self._record(filename, Humus._digest(content))
+        return content
+
+    def load(self, filename):
+        return yamlio.load(self.read(filename))
+
+    def map(self, filename):
+        """
+        Returns the content of ``filename`` as a read only buffer which
+        is memory mapped where the back-end keeps it in a file of its
+        own. Reads through ``map`` are not tracked.
+        """
+        return self._base.map(filename)
+
+    def digest(self, filename):
+        with self.open(filename) as fl:
+            return Humus._digest(fl.read())
+
+    def memoize(self, key, fn):
+        return fn()
+
+    @contextlib.contextmanager
+    def tracking(self):
+        """
+        Record every file read through this humus while the context is
+        active. Yields a dict which is filled in with the digest of
+        each file read keyed by filename.
+        """
+        reads = {}
+        self._trackers.append(reads)
+        try:
+            yield reads
+        finally:
+            self._trackers.remove(reads)
+
     def list(self, dirname):
         return self._base.list(dirname)
 
@@ -34,6 +78,34 @@ class Humus(object):
     def makedirs(self, dirname):
         return self._base.makedirs(dirname)
 
+    def deferred(self):
+        """
+        Returns a context manager which batches writes to the backing
+        store until the block exits.
+        """
+        return self._base.deferred()
+
+    def commit(self):
+        return self._base.commit()
+
+    def hosts(self):
+        """
+        Return the fully qualified name of every host found in the
+        ``/hosts`` section.
+        """
+        top = Humus._fnname_and_top('host')[1]
+        hostnames = []
+        stack = [[]]
+        while stack:
+            parts = stack.pop()
+            for name in self.list(top + '/'.join(parts)):
+                path = parts + [name]
+                if self.isdir(top + '/'.join(path)):
+                    stack.append(path)
+                else:
+                    hostnames.append('.'.join(reversed(path)))
+        return sorted(hostnames)
+
     def _setattr_path_to(self, section):
         fn_name, top = Humus._fnname_and_top(section)
         fn = lambda resource: Humus._path_to(top, resource)
@@ -44,6 +116,14 @@ class Humus(object):
         fn = lambda hostname: Humus._path_to_host(top, hostname)
         setattr(self, fn_name, fn)
 
+    def _record(self, filename, digest):
+        for reads in self._trackers:
+            reads[filename] = digest
+
+    @staticmethod
+    def _digest(content):
+        return hashlib.sha1(content).hexdigest()
+
     @staticmethod
     def _fnname_and_top(section):
         return 'path_to_{0}'.format(section), '/{0}s/'.format(section)
@@ -59,3 +139,56 @@ class Humus(object):
         path = [prefix]
         path.extend(part for part in reversed(hostname.split('.')))
         return '/'.join(path).replace('//', '/')
+
+class CachedHumus(Humus):
+    """
+    A humus which remembers everything it reads for the lifetime of
+    the instance. Use one of these when many hosts are seeded in a
+    single run so that each role, include, file definition and
+    content blob is read and parsed only once.
+
+    The objects returned from ``load`` and ``memoize`` are shared
+    between callers and must be treated as read-only.
+    """
+    def __init__(self, location, lazy=False):
+        super(CachedHumus, self).__init__(location, lazy=lazy)
+        self._reads = {}
+        self._loads = {}
+        self._memos = {}
+
+    def open(self, filename, mode='r'):
+        if mode != 'r':
+            self._reads.pop(filename, None)
+            self._loads.pop(filename, None)
+        return super(CachedHumus, self).open(filename, mode)
+
+    def read(self, filename):
+        if filename not in self._reads:
+            with self.open(filename) as fl:
+                content = fl.read()
+            self._reads[filename] = (content, Humus._digest(content))
+        content, digest = self._reads[filename]
+        self._record(filename, digest)
+        return content
+
+    def load(self, filename):
+        content = self.read(filename)
+        if filename not in self._loads:
+            self._loads[filename] = yamlio.load(content)
+        return self._loads[filename]
+
+    def digest(self, filename):
+        self.read(filename)
+        return self._reads[filename][1]
+
+    def memoize(self, key, fn):
+        # Remember what was read to build the value so that anyone
+        # tracking reads still sees them when the value is reused.
+        if key not in self._memos:
+            with self.tracking() as reads:
+                value = fn()
+            self._memos[key] = (value, reads)
+        value, reads = self._memos[key]
+        for filename, digest in reads.iteritems():
+            self._record(filename, digest)
+        return value
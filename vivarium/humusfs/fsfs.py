@@ -1,4 +1,6 @@
+import contextlib
 import errno
+import mmap
 import os
 
 class FSFS(object):
@@ -12,6 +14,14 @@ class FSFS(object):
             raise NotImplementedError, 'Please specify mode of r or w'
         return open(self._fullname(filename), mode)
 
+    def map(self, filename):
+        with open(self._fullname(filename), 'rb') as fl:
+            try:
+                return mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped.
+                return ''
+
     def list(self, dirname):
         return os.listdir(self._fullname(dirname))
 
@@ -21,6 +31,15 @@ class FSFS(object):
     def isdir(self, dirname):
         return os.path.isdir(self._fullname(dirname))
 
+    @contextlib.contextmanager
+    def deferred(self):
+        # Writes go straight to their own files so there is nothing to
+        # batch.
+        yield self
+
+    def commit(self):
+        pass
+
     def makedirs(self, dirname):
         try:
             return os.makedirs(self._fullname(dirname))
@@ -0,0 +1,62 @@
+"""
+Helpers for files which are kept between runs, such as caches, and
+so may be read back by a later process running as root.
+"""
+import errno
+import os
+import stat
+import tempfile
+
+def open_private(filename):
+    """
+    Open ``filename`` for reading. Returns ``None`` if it is missing
+    or unreadable, belongs to another user or may be written by
+    anyone other than its owner, since any of those could hand this
+    process whatever they liked.
+    """
+    try:
+        input = open(filename, 'rb')
+    except IOError:
+        return None
+    info = os.fstat(input.fileno())
+    if (info.st_uid != os.geteuid()
+        or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        input.close()
+        return None
+    return input
+
+def write_atomically(filename, data, mode=None):
+    """
+    Write ``data`` to a temporary file which is renamed over
+    ``filename`` so a reader never sees a partially written file. Any
+    missing directories are made first. The file gets ``mode`` if
+    given, otherwise it keeps the mode of the file it replaces.
+    """
+    filename = os.path.abspath(filename)
+    dirname, basename = os.path.split(filename)
+    try:
+        os.makedirs(dirname)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST: raise
+    if mode is None:
+        mode = _file_mode(filename)
+    fd, temp_name = tempfile.mkstemp(prefix='.' + basename, dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.chmod(temp_name, mode)
+        os.rename(temp_name, filename)
+    except:
+        os.unlink(temp_name)
+        raise
+
+def _file_mode(filename):
+    try:
+        return os.stat(filename).st_mode & 07777
+    except OSError as exc:
+        if exc.errno != errno.ENOENT: raise
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
@@ -1,6 +1,8 @@
 import errno
+import marshal
 import os.path
 
+from .. import yamlio
 from ..yamlfs import YamlFS
 
 def fullname(filename):
@@ -113,3 +115,113 @@ def test_makedirs():
     with yfs.open(file_inside) as fl:
         assert fl.read() == contents
     os.remove(fullname(yaml_file))
+
+def test_deferred_writes_on_exit():
+    yaml_file = 'temp.yaml'
+    yfs = YamlFS(fullname(yaml_file))
+    with yfs.deferred():
+        for name in ['one', 'two']:
+            with yfs.open('/deferred/' + name, 'w') as fl:
+                fl.write(name)
+        assert not os.path.exists(fullname(yaml_file))
+    yfs = YamlFS(fullname(yaml_file))
+    assert 2 == len(yfs.list('/deferred'))
+    os.remove(fullname(yaml_file))
+
+def test_deferred_not_written_on_error():
+    yaml_file = 'temp.yaml'
+    yfs = YamlFS(fullname(yaml_file))
+    try:
+        with yfs.deferred():
+            with yfs.open('/something', 'w') as fl:
+                fl.write('contents')
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert not os.path.exists(fullname(yaml_file))
+    yfs.commit()
+    assert os.path.exists(fullname(yaml_file))
+    os.remove(fullname(yaml_file))
+
+def test_cache_follows_file_content():
+    yaml_file = 'temp.yaml'
+    yfs = YamlFS(fullname(yaml_file))
+    with yfs.open('/something', 'w') as fl:
+        fl.write('cached')
+    cache_file = yfs._cache_filename()
+    assert os.path.exists(cache_file)
+    assert YamlFS(fullname(yaml_file)).open('/something').read() == 'cached'
+    with open(fullname(yaml_file), 'w') as fl:
+        fl.write('something: edited\n')
+    assert YamlFS(fullname(yaml_file)).open('/something').read() == 'edited'
+    os.remove(fullname(yaml_file))
+    os.remove(cache_file)
+
+def test_cache_of_another_user_is_ignored():
+    yaml_file = 'temp.yaml'
+    yfs = YamlFS(fullname(yaml_file))
+    with yfs.open('/something', 'w') as fl:
+        fl.write('cached')
+    cache_file = yfs._cache_filename()
+    digest = YamlFS._digest_file(fullname(yaml_file))
+    with open(cache_file, 'wb') as fl:
+        marshal.dump((digest, {'something': 'planted'}), fl)
+    assert YamlFS(fullname(yaml_file)).open('/something').read() == 'planted'
+    os.chmod(cache_file, 0666)
+    assert YamlFS(fullname(yaml_file)).open('/something').read() == 'cached'
+    os.chmod(cache_file, 0644)
+    if os.geteuid() == 0:
+        os.chown(cache_file, 1, -1)
+        yfs = YamlFS(fullname(yaml_file))
+        assert yfs.open('/something').read() == 'cached'
+    os.remove(fullname(yaml_file))
+    os.remove(cache_file)
+
+def test_load_python_string_tags():
+    loaded = yamlio.load("a: !!python/str hi\nb: !!python/unicode there\n")
+    assert loaded == {'a': 'hi', 'b': 'there'}
+
+def test_lazy_reads_through_index():
+    yaml_file = 'temp.yaml'
+    yfs = YamlFS(fullname(yaml_file))
+    with yfs.deferred():
+        for path in ['/a/b/c', '/a/d', '/e/f']:
+            yfs.makedirs(os.path.dirname(path))
+            with yfs.open(path, 'w') as fl:
+                fl.write(path)
+    YamlFS(fullname(yaml_file), lazy=True)
+    yfs = YamlFS(fullname(yaml_file), lazy=True)
+    index_file = yfs._index_filename()
+    assert os.path.exists(index_file)
+    assert isinstance(yfs._fs._items['a'], tuple)
+    assert yfs.open('/a/b/c').read() == '/a/b/c'
+    assert isinstance(yfs._fs._items['e'], tuple)
+    assert sorted(yfs.list('/a')) == ['b', 'd']
+    assert yfs.isdir('/a/b')
+    with yfs.open('/e/g', 'w') as fl:
+        fl.write('new')
+    yfs = YamlFS(fullname(yaml_file))
+    assert yfs.open('/a/d').read() == '/a/d'
+    assert yfs.open('/e/g').read() == 'new'
+    os.remove(fullname(yaml_file))
+    os.remove(yfs._cache_filename())
+    os.remove(index_file)
+
+def test_lazy_dict_never_shows_placeholders():
+    yaml_file = 'temp.yaml'
+    yfs = YamlFS(fullname(yaml_file))
+    with yfs.deferred():
+        yfs.makedirs('/a/b')
+        with yfs.open('/a/b/c', 'w') as fl:
+            fl.write('x')
+        with yfs.open('/a/d', 'w') as fl:
+            fl.write('y')
+    yfs = YamlFS(fullname(yaml_file), lazy=True)
+    yfs = YamlFS(fullname(yaml_file), lazy=True)
+    node = yfs._fs['a']
+    assert sorted(node.items()) == [('b', {'c': 'x'}), ('d', 'y')]
+    assert node == {'b': {'c': 'x'}, 'd': 'y'}
+    assert node.copy() == {'b': {'c': 'x'}, 'd': 'y'}
+    os.remove(fullname(yaml_file))
+    os.remove(yfs._cache_filename())
+    os.remove(yfs._index_filename())
@@ -1,6 +1,15 @@
+import collections
+import contextlib
 import errno
 import cStringIO as stringio
-import yaml
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+
+import safeio
+import yamlio
 
 class YamlFS(object):
     class File(object):
@@ -8,7 +17,10 @@ class YamlFS(object):
             self._name = name
             self._node = node
             if 'r' == mode:
-                self._file = stringio.StringIO(node[name])
+                try:
+                    self._file = stringio.StringIO(node[name])
+                except KeyError:
+                    raise IOError, errno.ENOENT
             elif 'w' == mode:
                 self._file = stringio.StringIO()
             else:
@@ -41,13 +53,29 @@ class YamlFS(object):
             self.flush()
             self._file.close()
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache=True, lazy=False):
+        """
+        Open the yaml humus in ``filename``. Unless ``cache`` is false
+        the parsed tree is also kept next to the file and reused while
+        the content of the file is unchanged.
+
+        If ``lazy`` is true the tree is kept as a compiled index
+        instead, and each mapping in the tree is only read from the
+        index when it is first accessed.
+        """
         self._filename = filename
-        try:
-            self._fs = yaml.load(open(self._filename))
-        except IOError as exc:
-            if exc.errno == errno.ENOENT: self._fs = {}
-            else: raise
+        self._cache = cache
+        self._lazy = lazy
+        self._deferred = 0
+        self._is_dirty = False
+        digest = YamlFS._digest_file(self._filename)
+        if self._lazy:
+            self._fs = self._load_index(digest)
+        else:
+            self._fs = self._load_cache(digest)
+        if self._fs is None:
+            self._fs = self._parse()
+            self._store_sidecar(digest)
 
     def open(self, filename, mode = 'r'):
         if filename.startswith('/'):
@@ -64,6 +92,12 @@ class YamlFS(object):
         # *NOTE: split out so we can handle new files.
         return YamlFS.File(rv, paths[-1], mode, self)
 
+    def map(self, filename):
+        # The file is only a string in the tree so there is nothing
+        # to map.
+        with self.open(filename, 'r') as fl:
+            return fl.read()
+
     def list(self, dirname):
         directory = self._descend_path(dirname)
         return directory.keys()
@@ -74,7 +108,34 @@ class YamlFS(object):
 
     def isdir(self, dirname):
         dr = self._descend_path(dirname)
-        return isinstance(dr, dict)
+        return isinstance(dr, collections.Mapping)
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """
+        Hold all writes in memory until the outermost ``deferred``
+        block exits and then write the tree out once. If the block
+        raises, nothing is written.
+        """
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+        if not self._deferred:
+            self.commit()
+
+    def commit(self):
+        "Write the tree to disk if it has changed."
+        if not self._is_dirty:
+            return
+        if self._lazy:
+            # Everything has to be read to write the file anyway.
+            self._fs = _materialize(self._fs)
+        text = yamlio.dump(self._fs)
+        safeio.write_atomically(self._filename, text)
+        self._store_sidecar(hashlib.sha1(text).hexdigest())
+        self._is_dirty = False
 
     def makedirs(self, dirname):
         paths = dirname.split('/')
@@ -107,4 +168,177 @@ class YamlFS(object):
 
     def _sync(self):
         # print "SYNC {0}".format(self._fs)
-        yaml.dump(self._fs, stream=open(self._filename, 'w'))
+        self._is_dirty = True
+        if not self._deferred:
+            self.commit()
+
+    def _parse(self):
+        try:
+            with open(self._filename, 'rb') as input:
+                return yamlio.load(input.read()) or {}
+        except IOError as exc:
+            if exc.errno == errno.ENOENT: return {}
+            else: raise
+
+    def _sidecar_filename(self, suffix):
+        dirname, basename = os.path.split(os.path.abspath(self._filename))
+        return os.path.join(dirname, '.{0}.{1}'.format(basename, suffix))
+
+    def _cache_filename(self):
+        return self._sidecar_filename('cache')
+
+    def _index_filename(self):
+        return self._sidecar_filename('index')
+
+    def _load_cache(self, digest):
+        if not self._cache:
+            return None
+        input = safeio.open_private(self._cache_filename())
+        if input is None:
+            return None
+        try:
+            with input:
+                cached_digest, tree = marshal.load(input)
+        except Exception:
+            # A missing, stale or damaged cache just means parsing.
+            return None
+        if cached_digest != digest:
+            return None
+        return tree
+
+    def _load_index(self, digest):
+        if not self._cache:
+            return None
+        input = safeio.open_private(self._index_filename())
+        if input is None:
+            return None
+        try:
+            with input:
+                index = _Index(mmap.mmap(
+                    input.fileno(), 0, access=mmap.ACCESS_READ))
+            if index.digest != digest:
+                return None
+            return index.root()
+        except Exception:
+            return None
+
+    def _store_sidecar(self, digest):
+        if not self._cache or not os.path.exists(self._filename):
+            return
+        try:
+            if self._lazy:
+                filename = self._index_filename()
+                data = _Index.compile(self._fs, digest)
+            else:
+                filename = self._cache_filename()
+                data = marshal.dumps((digest, self._fs), 2)
+        except ValueError:
+            # Only plain data is cached, eg not yaml timestamps.
+            return
+        try:
+            safeio.write_atomically(filename, data)
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def _digest_file(filename):
+        digest = hashlib.sha1()
+        try:
+            with open(filename, 'rb') as input:
+                for chunk in iter(lambda: input.read(1 << 16), ''):
+                    digest.update(chunk)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT: raise
+        return digest.hexdigest()
+
+class _LazyDict(collections.MutableMapping):
+    """
+    A mapping read from an ``_Index``. Nested mappings are held as
+    ``(offset, length)`` placeholders -- safe yaml never produces
+    tuples -- and replaced with the real mapping on first access.
+    Every read goes through ``__getitem__`` so a placeholder is never
+    seen outside.
+    """
+    def __init__(self, index, items):
+        self._index = index
+        self._items = items
+
+    def __getitem__(self, key):
+        value = self._items[key]
+        if isinstance(value, tuple):
+            value = self._index.node(value)
+            self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def has_key(self, key):
+        return key in self._items
+
+    def copy(self):
+        return dict(self.iteritems())
+
+class _Index(object):
+    """
+    A compiled yaml tree where every mapping is marshalled on its own
+    so that any one of them can be read without reading the rest. The
+    layout is a length prefixed header of ``(digest, root)`` followed
+    by the mappings.
+    """
+    _header = struct.Struct('!I')
+
+    def __init__(self, data):
+        self._data = data
+        size = _Index._header.size
+        length, = _Index._header.unpack(data[:size])
+        self.digest, self._root = marshal.loads(data[size:size + length])
+        self._base = size + length
+
+    def root(self):
+        return self.node(self._root)
+
+    def node(self, location):
+        offset, length = location
+        start = self._base + offset
+        return _LazyDict(
+            self, marshal.loads(self._data[start:start + length]))
+
+    @staticmethod
+    def compile(tree, digest):
+        records = []
+        position = [0]
+        def add(node):
+            items = {}
+            for key, value in node.iteritems():
+                if isinstance(value, collections.Mapping):
+                    items[key] = add(value)
+                else:
+                    items[key] = value
+            record = marshal.dumps(items, 2)
+            records.append(record)
+            location = (position[0], len(record))
+            position[0] += len(record)
+            return location
+        root = add(tree)
+        header = marshal.dumps((digest, root), 2)
+        records.insert(0, _Index._header.pack(len(header)) + header)
+        return ''.join(records)
+
+def _materialize(node):
+    "Return ``node`` as plain dicts with every placeholder read."
+    if not isinstance(node, collections.Mapping):
+        return node
+    return dict((key, _materialize(node[key])) for key in node.keys())
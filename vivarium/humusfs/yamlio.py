@@ -0,0 +1,49 @@
+"""
+Thin wrappers around yaml which use the libyaml C implementation when
+it is available and fall back to the pure python one when it is not.
+Either way only the safe loader and dumper are used so documents only
+ever contain plain data.
+
+Any read only mapping is written as a plain mapping, and an object
+which appears more than once is written out in full each time rather
+than as an alias, so every document stands on its own.
+"""
+import collections
+import yaml
+
+try:
+    from yaml import CSafeLoader as _BaseLoader
+    from yaml import CSafeDumper as _BaseDumper
+except ImportError:
+    from yaml import SafeLoader as _BaseLoader
+    from yaml import SafeDumper as _BaseDumper
+
+class Loader(_BaseLoader):
+    def construct_mapping(self, node, deep=False):
+        # File modes are parsed by vivarium itself, so keep them as
+        # written. yaml would read an unquoted 644 as decimal.
+        for key_node, value_node in node.value:
+            if (isinstance(key_node, yaml.ScalarNode)
+                and key_node.value == u'mode'
+                and value_node.tag == u'tag:yaml.org,2002:int'):
+                value_node.tag = u'tag:yaml.org,2002:str'
+        return super(Loader, self).construct_mapping(node, deep)
+
+class Dumper(_BaseDumper):
+    def ignore_aliases(self, data):
+        return True
+
+Dumper.add_multi_representer(collections.Mapping, Dumper.represent_dict)
+
+# Documents written with the full dumper may tag strings with python
+# specific tags. Read those back as plain strings.
+for _tag in ['python/str', 'python/unicode']:
+    Loader.add_constructor(
+        u'tag:yaml.org,2002:' + _tag,
+        Loader.construct_yaml_str)
+
+def load(stream):
+    return yaml.load(stream, Loader=Loader)
+
+def dump(data, stream=None):
+    return yaml.dump(data, stream=stream, Dumper=Dumper)
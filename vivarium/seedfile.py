@@ -0,0 +1,172 @@
+"""
+Reading and writing host seeds.
+
+A seed is written either as yaml or in a compact binary format which
+is much quicker for plant to read back. The binary format is a fixed
+header, the seed itself in ``marshal`` format, and then every long
+string in the seed as a blob prefixed with its length::
+
+  magic (7 bytes) | version (1 byte) | length of tree (8 bytes)
+  tree
+  length (8 bytes) | blob
+  ...
+
+Inside the tree a blob is replaced by the tuple of its offset and
+length relative to the end of the tree. Seeds loaded from yaml never
+contain tuples so the two cannot be confused. ``load`` tells the
+formats apart by the magic, which yaml can never start with.
+
+A binary seed may also be loaded lazily from a memory mapped file. It
+is then returned as read only views of the tree which only slice a
+blob out of the file when it is reached, and ``thaw`` turns any part
+of it into plain dicts and lists.
+"""
+
+import collections
+import marshal
+import struct
+
+import humusfs.yamlio as yamlio
+
+class SeedFormatError(Exception):
+    pass
+
+FORMATS = ['yaml', 'binary']
+
+MAGIC = '\x00vvseed'
+VERSION = 1
+# Strings at least this long are stored as blobs.
+BLOB_THRESHOLD = 256
+
+_HEADER = struct.Struct('>7sBQ')
+_LENGTH = struct.Struct('>Q')
+
+def dump(seed, format='yaml'):
+    "Returns ``seed`` serialized in ``format``."
+    if format == 'yaml':
+        return yamlio.dump(seed)
+    elif format == 'binary':
+        return dump_binary(seed)
+    msg = "Unknown seed format: {0}"
+    raise SeedFormatError, msg.format(format)
+
+def load(data, lazy=False):
+    """
+    Returns the seed serialized in ``data`` in either format. When
+    ``lazy`` a binary seed is returned as views of ``data``, which
+    must then stay valid for as long as the seed is used.
+    """
+    if isinstance(data, unicode):
+        # A binary seed stored in a yaml spawn may be read back as
+        # unicode if it happened to be valid utf-8.
+        data = data.encode('utf-8')
+    if is_binary(data):
+        return load_binary(data, lazy)
+    if not isinstance(data, str):
+        data = data[:]
+    return yamlio.load(data)
+
+def thaw(obj):
+    "Returns a plain copy of ``obj`` with every view decoded."
+    if isinstance(obj, collections.Mapping):
+        return dict((key, thaw(value)) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, _LazyList)):
+        return [thaw(item) for item in obj]
+    return obj
+
+def is_binary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def dump_binary(seed):
+    blobs = []
+    offset = [0]
+    def _pack(obj):
+        if isinstance(obj, collections.Mapping):
+            return dict((key, _pack(value)) for key, value in obj.iteritems())
+        elif isinstance(obj, list):
+            return [_pack(item) for item in obj]
+        elif isinstance(obj, str) and len(obj) >= BLOB_THRESHOLD:
+            ref = (offset[0] + _LENGTH.size, len(obj))
+            blobs.append(_LENGTH.pack(len(obj)))
+            blobs.append(obj)
+            offset[0] += _LENGTH.size + len(obj)
+            return ref
+        return obj
+    try:
+        tree = marshal.dumps(_pack(seed), 2)
+    except ValueError, e:
+        raise SeedFormatError, "Unable to write binary seed: {0}".format(e)
+    header = _HEADER.pack(MAGIC, VERSION, len(tree))
+    return ''.join([header, tree] + blobs)
+
+def load_binary(data, lazy=False):
+    if len(data) < _HEADER.size:
+        raise SeedFormatError, "Truncated seed"
+    magic, version, length = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SeedFormatError, "Not a binary seed"
+    if version != VERSION:
+        msg = "Unsupported seed version: {0}"
+        raise SeedFormatError, msg.format(version)
+    start = _HEADER.size
+    tree = marshal.loads(buffer(data, start, length))
+    base = start + length
+    if lazy:
+        return _lazy(tree, data, base)
+    def _unpack(obj):
+        if isinstance(obj, dict):
+            return dict((key, _unpack(value))
+                        for key, value in obj.iteritems())
+        elif isinstance(obj, list):
+            return [_unpack(item) for item in obj]
+        elif isinstance(obj, tuple):
+            offset, size = obj
+            return data[base + offset:base + offset + size]
+        return obj
+    return _unpack(tree)
+
+def _lazy(obj, data, base):
+    if isinstance(obj, dict):
+        return _LazyMapping(obj, data, base)
+    elif isinstance(obj, list):
+        return _LazyList(obj, data, base)
+    elif isinstance(obj, tuple):
+        offset, size = obj
+        return data[base + offset:base + offset + size]
+    return obj
+
+class _LazyMapping(collections.Mapping):
+    """
+    Read only view of a dict in a lazily loaded binary seed. Blobs are
+    sliced out of the seed each time they are looked up rather than
+    kept.
+    """
+    def __init__(self, node, data, base):
+        self._node = node
+        self._data = data
+        self._base = base
+
+    def __getitem__(self, key):
+        return _lazy(self._node[key], self._data, self._base)
+
+    def __iter__(self):
+        return iter(self._node)
+
+    def __len__(self):
+        return len(self._node)
+
+    def has_key(self, key):
+        return key in self._node
+
+class _LazyList(collections.Sequence):
+    "Read only view of a list in a lazily loaded binary seed."
+    def __init__(self, node, data, base):
+        self._node = node
+        self._data = data
+        self._base = base
+
+    def __getitem__(self, index):
+        return _lazy(self._node[index], self._data, self._base)
+
+    def __len__(self):
+        return len(self._node)
@@ -0,0 +1,156 @@
+from nose.tools import *
+import argparse
+import grp
+import os
+import pwd
+import shutil
+import stat
+import tempfile
+
+from ..vivarium import ActionContext
+from ..vivarium import File
+from ..vivarium import Owners
+from ..vivarium import UnknownOwnerError
+
+class LocalEnvironment(object):
+    def work(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def mkdir(self, dirname):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+root = None
+
+def setup():
+    global root
+    root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(root, 'stage'))
+
+def teardown():
+    shutil.rmtree(root)
+
+def _ctxt(converge=True, threshold=File.MEMORY_THRESHOLD):
+    args = argparse.Namespace(
+        converge=converge, template_cache=None, memory_threshold=threshold)
+    return ActionContext(
+        LocalEnvironment(), 'target', 0, {}, {}, {}, args)
+
+def _sow_and_plant(seed, name, converge=True, threshold=File.MEMORY_THRESHOLD):
+    vvfile = File().from_seed(seed)
+    staged = os.path.join(root, 'stage', name)
+    ctxt = _ctxt(converge, threshold)
+    vvfile.sow(staged, ctxt)
+    return vvfile.plant(staged, seed['location'], ctxt)
+
+def test_regular_file_converges():
+    location = os.path.join(root, 'motd')
+    seed = dict(location=location, type='regular', content='hi\n',
+                mode='0640')
+    eq_(_sow_and_plant(seed, 'motd'), (1, 0))
+    eq_(stat.S_IMODE(os.stat(location).st_mode), 0640)
+    os.utime(location, (0, 0))
+    eq_(_sow_and_plant(seed, 'motd'), (0, 1))
+    eq_(os.stat(location).st_mtime, 0)
+    os.chmod(location, 0600)
+    eq_(_sow_and_plant(seed, 'motd'), (1, 0))
+    eq_(os.stat(location).st_mtime, 0)
+    eq_(stat.S_IMODE(os.stat(location).st_mode), 0640)
+    seed['content'] = 'changed\n'
+    eq_(_sow_and_plant(seed, 'motd'), (1, 0))
+    eq_(open(location).read(), 'changed\n')
+
+def test_dir_converges():
+    location = os.path.join(root, 'sites')
+    seed = dict(location=location, type='dir', files=[
+        dict(location=os.path.join(location, 'default'),
+             type='regular', content='site\n'),
+        dict(location=os.path.join(location, 'link'),
+             type='sym', target='default'),
+        ])
+    eq_(_sow_and_plant(seed, 'sites'), (3, 0))
+    eq_(os.readlink(os.path.join(location, 'link')), 'default')
+    eq_(open(os.path.join(location, 'default')).read(), 'site\n')
+    eq_(_sow_and_plant(seed, 'sites'), (0, 3))
+    open(os.path.join(location, 'extra'), 'w').close()
+    eq_(_sow_and_plant(seed, 'sites'), (1, 2))
+    assert not os.path.exists(os.path.join(location, 'extra'))
+
+def test_dir_replaces_only_differing_entries():
+    location = os.path.join(root, 'conf.d')
+    def _seed(content):
+        return dict(location=location, type='dir', files=[
+            dict(location=os.path.join(location, 'a'),
+                 type='regular', content='a\n'),
+            dict(location=os.path.join(location, 'b'),
+                 type='regular', content=content),
+            ])
+    eq_(_sow_and_plant(_seed('b\n'), 'conf.d', converge=False), (3, 0))
+    inodes = dict((name, os.stat(os.path.join(location, name)).st_ino)
+                  for name in ('.', 'a', 'b'))
+    eq_(_sow_and_plant(_seed('new\n'), 'conf.d', converge=False), (1, 2))
+    eq_(open(os.path.join(location, 'b')).read(), 'new\n')
+    eq_(os.stat(location).st_ino, inodes['.'])
+    eq_(os.stat(os.path.join(location, 'a')).st_ino, inodes['a'])
+    assert os.stat(os.path.join(location, 'b')).st_ino != inodes['b']
+    eq_(sorted(os.listdir(location)), ['a', 'b'])
+
+def test_file_replaces_dir():
+    location = os.path.join(root, 'was_dir')
+    os.mkdir(location)
+    seed = dict(location=location, type='regular', content='file\n')
+    eq_(_sow_and_plant(seed, 'was_dir'), (1, 0))
+    eq_(open(location).read(), 'file\n')
+
+def test_without_converge_always_changes():
+    location = os.path.join(root, 'always')
+    seed = dict(location=location, type='regular', content='hi\n')
+    eq_(_sow_and_plant(seed, 'always', converge=False), (1, 0))
+    eq_(_sow_and_plant(seed, 'always', converge=False), (1, 0))
+
+def test_small_file_skips_stage():
+    location = os.path.join(root, 'small')
+    seed = dict(location=location, type='regular', content='small\n')
+    eq_(_sow_and_plant(seed, 'small', converge=False), (1, 0))
+    assert not os.path.exists(os.path.join(root, 'stage', 'small'))
+    eq_(open(location).read(), 'small\n')
+
+def test_large_file_is_staged():
+    location = os.path.join(root, 'large')
+    seed = dict(location=location, type='regular', content='large\n')
+    vvfile = File().from_seed(seed)
+    staged = os.path.join(root, 'stage', 'large')
+    ctxt = _ctxt(False, threshold=0)
+    vvfile.sow(staged, ctxt)
+    eq_(ctxt.sown, {})
+    eq_(open(staged).read(), 'large\n')
+    eq_(vvfile.plant(staged, location, ctxt), (1, 0))
+    eq_(open(location).read(), 'large\n')
+
+def test_owners_are_cached():
+    owners = Owners()
+    name = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+    eq_(owners.uid(name), os.getuid())
+    eq_(owners.gid(group), os.getgid())
+    owners._uids[name] = 12345
+    eq_(owners.uid(name), 12345)
+    owners.invalidate()
+    eq_(owners.uid(name), os.getuid())
+
+def test_unknown_owner_fails_before_planting():
+    location = os.path.join(root, 'owned')
+    seed = dict(location=location, type='dir', files=[
+        dict(location=os.path.join(location, 'ok'),
+             type='regular', content='ok\n'),
+        dict(location=os.path.join(location, 'bad'),
+             type='regular', content='bad\n',
+             owner='no-such-user-vv', group='no-such-group-vv'),
+        ])
+    vvfile = File().from_seed(seed)
+    ctxt = _ctxt()
+    assert_raises(UnknownOwnerError, vvfile.check_owners, ctxt)
+    staged = os.path.join(root, 'stage', 'owned')
+    vvfile.sow(staged, ctxt)
+    assert_raises(UnknownOwnerError, vvfile.plant, staged, location, ctxt)
+    assert not os.path.exists(location)
@@ -1,7 +1,10 @@
 from nose.tools import *
 import os.path
+import tempfile
 
 from ..humus import Humus
+from ..humusfs import yamlio
+from ..vivarium import BadMode
 from ..vivarium import File
 
 source = None
@@ -27,8 +30,22 @@ def test_simple_file():
     eq_(fl.owner, 'root')
     eq_(fl.group, 'root')
     eq_(fl.mode, 'u=rw,go=r')
+    eq_(fl.mode_bits, 0644)
     eq_(fl._template, 'etc.hosts.content')
 
+def test_mode_in_seed():
+    seed = File().from_source(source, 'etc.hosts').to_seed()
+    assert 'mode' not in seed
+    eq_(seed['mode_bits'], 0644)
+    assert 'mode_mask' not in seed
+    fl = File().from_seed(seed)
+    eq_(fl._file_mode(), 0644)
+
+def test_legacy_mode_in_seed():
+    fl = File().from_seed(dict(
+        location='/etc/motd', type='regular', content='', mode='0600'))
+    eq_(fl._file_mode(), 0600)
+
 def test_absent():
     fl = File().from_source(source, 'etc.absent')
     eq_(fl.type, File.IS.absent)
@@ -54,4 +71,70 @@ def test_dir_external():
     eq_(node.type, 'regular')
     eq_(node.location, '/etc/apache2/modules-available/proxy.load')
     eq_(node._content, 'apache.proxy.load.content')
-    
+
+def _mode(mode_string, is_dir=False):
+    return File._parse_mode(mode_string, is_dir)
+
+def test_parse_octal():
+    eq_(_mode('644'), (0644, 07777))
+    eq_(_mode('4755'), (04755, 07777))
+    eq_(_mode('04755'), (04755, 07777))
+    assert_raises(BadMode, _mode, '0648')
+    assert_raises(BadMode, _mode, '01777777')
+
+def test_parse_absolute():
+    eq_(_mode('u=rw,go=r'), (0644, 07777))
+    eq_(_mode('a=rwx'), (0777, 07777))
+    eq_(_mode('u=rwx,g=u,o='), (0770, 07777))
+
+def test_parse_relative():
+    eq_(_mode('u+x'), (0100, 0100))
+    eq_(_mode('go-w'), (0, 0022))
+    eq_(_mode('u=rw,o+r'), (0604, 04704))
+    eq_(_mode('+t'), (01000, 01000))
+    eq_(_mode('ug+s'), (06000, 06000))
+    eq_(_mode('u+rw-x'), (0600, 0700))
+
+def test_parse_only_equals_is_absolute():
+    eq_(_mode('u=rw'), (0600, 07777))
+    eq_(_mode('u=rwx,g=rx'), (0750, 07777))
+
+def test_yaml_octal_mode():
+    config = yamlio.load('mode: 0600\n')
+    eq_(config['mode'], '0600')
+    fl = File()._load_config(config, source, '/etc/x')
+    eq_((fl.mode_bits, fl.mode_mask), (0600, 07777))
+    for mode in ('644', '755', '0644', '0755', '04755'):
+        config = yamlio.load('mode: {0}\n'.format(mode))
+        fl = File()._load_config(config, source, '/etc/x')
+        eq_(fl._file_mode(), int(mode, 8))
+    assert_raises(BadMode, File()._load_config,
+                  yamlio.load('mode: 999\n'), source, '/etc/x')
+    eq_(yamlio.load('size: 644\n'), {'size': 644})
+    assert_raises(BadMode, File()._load_config,
+                  dict(mode=010000), source, '/etc/x')
+
+def test_parse_big_x():
+    eq_(_mode('a=r,a+X'), (0444, 07777))
+    eq_(_mode('a=r,a+X', is_dir=True), (0555, 07777))
+    eq_(_mode('u=rx,go=r,a+X'), (0555, 07777))
+
+def test_parse_bad():
+    for bad in ('', 'u', 'u=q', 'z=r', 'u=r,', 'g=u', 'u=rw*'):
+        assert_raises(BadMode, _mode, bad)
+
+def test_bad_mode_fails_at_seed():
+    config = dict(mode='u=rwz')
+    assert_raises(BadMode, File()._load_config, config, source, '/etc/x')
+
+def test_relative_mode_keeps_other_bits():
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        os.chmod(filename, 0640)
+        fl = File().from_seed(dict(
+            location=filename, type='regular', content='',
+            mode_bits=0100, mode_mask=0100))
+        eq_(fl._file_mode(filename), 0740)
+    finally:
+        os.unlink(filename)
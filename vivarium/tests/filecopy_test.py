@@ -0,0 +1,79 @@
+from nose.tools import *
+import os
+import shutil
+import tempfile
+
+from .. import filecopy
+
+root = None
+
+class NeverWorks(filecopy.CopyStrategy):
+    name = 'never'
+    def __init__(self):
+        self.calls = 0
+    def place(self, src_filename, temp_filename):
+        self.calls += 1
+        raise filecopy.Unsupported, 'never'
+
+def setup():
+    global root
+    root = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(root)
+    filecopy.FileCopier().__init__()
+
+def _staged(name, content='x' * 100000):
+    filename = os.path.join(root, name)
+    with open(filename, 'wb') as output:
+        output.write(content)
+    return filename
+
+def test_buffered():
+    src = _staged('buffered')
+    filecopy.Buffered().place(src, src + '.out')
+    eq_(open(src + '.out').read(), open(src).read())
+
+def test_kernel():
+    src = _staged('kernel')
+    try:
+        filecopy.KernelCopy().place(src, src + '.out')
+    except filecopy.Unsupported:
+        return
+    eq_(open(src + '.out').read(), open(src).read())
+
+def test_kernel_empty():
+    src = _staged('kernel_empty', '')
+    try:
+        filecopy.KernelCopy().place(src, src + '.out')
+    except filecopy.Unsupported:
+        return
+    eq_(open(src + '.out').read(), '')
+
+def test_reflink():
+    src = _staged('reflink')
+    try:
+        filecopy.Reflink().place(src, src + '.out')
+    except filecopy.Unsupported:
+        return
+    eq_(open(src + '.out').read(), open(src).read())
+
+def test_rename_on_same_filesystem():
+    copier = filecopy.FileCopier()
+    copier.reset()
+    src = _staged('rename', 'renamed')
+    strategy = copier.place(src, src + '.out')
+    eq_(strategy.name, 'rename')
+    assert not os.path.exists(src)
+    eq_(open(src + '.out').read(), 'renamed')
+
+def test_fallback_is_remembered():
+    copier = filecopy.FileCopier()
+    never = NeverWorks()
+    copier.strategies = [never, filecopy.Buffered()]
+    copier.reset()
+    for name in ('first', 'second'):
+        src = _staged(name, name)
+        eq_(copier.place(src, src + '.out').name, 'buffered')
+        eq_(open(src + '.out').read(), name)
+    eq_(never.calls, 1)
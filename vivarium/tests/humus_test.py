@@ -0,0 +1,48 @@
+from nose.tools import *
+import os.path
+
+from ..humus import CachedHumus
+from ..humus import Humus
+
+def fullname(filename):
+    return os.path.join(os.path.dirname(__file__), filename)
+
+def test_hosts():
+    source = Humus(fullname('hosts.yaml'))
+    eq_(source.hosts(), ['db.example.org', 'mail.example.com', 'www.example.com'])
+
+def test_uncached_load_is_fresh():
+    source = Humus(fullname('hosts.yaml'))
+    filename = source.path_to_role('www')
+    assert source.load(filename) is not source.load(filename)
+
+def test_cached_load_is_shared():
+    source = CachedHumus(fullname('hosts.yaml'))
+    filename = source.path_to_role('www')
+    assert source.load(filename) is source.load(filename)
+
+def test_cached_memoize():
+    source = CachedHumus(fullname('hosts.yaml'))
+    calls = []
+    def fn():
+        calls.append(1)
+        return len(calls)
+    eq_(source.memoize('key', fn), 1)
+    eq_(source.memoize('key', fn), 1)
+    eq_(len(calls), 1)
+
+def test_tracking_records_reads():
+    source = Humus(fullname('hosts.yaml'))
+    filename = source.path_to_role('www')
+    with source.tracking() as reads:
+        source.load(filename)
+    eq_(reads.keys(), [filename])
+    eq_(reads[filename], source.digest(filename))
+
+def test_tracking_sees_memoized_reads():
+    source = CachedHumus(fullname('hosts.yaml'))
+    filename = source.path_to_role('www')
+    source.memoize('www', lambda: source.load(filename))
+    with source.tracking() as reads:
+        source.memoize('www', lambda: source.load(filename))
+    eq_(reads.keys(), [filename])
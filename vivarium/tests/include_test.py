@@ -0,0 +1,72 @@
+from nose.tools import *
+
+from ..vivarium import Entity
+from ..vivarium import IncludeLoopError
+from ..vivarium import IncludeResolver
+
+class FakeSource(object):
+    def __init__(self, includes, memoize=False):
+        self.includes = includes
+        self.loads = []
+        self.memos = {} if memoize else None
+
+    def path_to_include(self, name):
+        return name
+
+    def load(self, filename):
+        self.loads.append(filename)
+        return self.includes[filename]
+
+    def memoize(self, key, fn):
+        if self.memos is None:
+            return fn()
+        if key not in self.memos:
+            self.memos[key] = fn()
+        return self.memos[key]
+
+diamond = {
+    'base': dict(env=dict(greeting='hello', port=1)),
+    'web': dict(includes=['base'], env=dict(port=80)),
+    'mail': dict(includes=['base'], env=dict(relay='localhost')),
+    'host': dict(includes=['web', 'mail'], env=dict(name='www')),
+    }
+
+def test_diamond_loads_each_include_once():
+    source = FakeSource(diamond)
+    entity = Entity(name='host')
+    entity._load_config(source, 'host')
+    eq_(sorted(source.loads), ['base', 'host', 'mail', 'web'])
+    env = entity._config['env']
+    eq_(env['greeting'], 'hello')
+    eq_(env['port'], 80)
+    eq_(env['relay'], 'localhost')
+    eq_(env['name'], 'www')
+    eq_(entity.include_graph,
+        {'web': ['base'], 'mail': ['base'], 'base': []})
+
+def test_memo_is_shared_between_entities():
+    source = FakeSource(diamond, memoize=True)
+    Entity(name='host')._load_config(source, 'host')
+    entity = Entity(name='mail')
+    entity._load_config(source, 'mail')
+    eq_(source.loads.count('base'), 1)
+    eq_(entity._config['env']['greeting'], 'hello')
+    eq_(entity.include_graph, {'base': []})
+
+def test_loop():
+    source = FakeSource({
+        'a': dict(includes=['b']),
+        'b': dict(includes=['c']),
+        'c': dict(includes=['a']),
+        'host': dict(includes=['a']),
+        })
+    try:
+        Entity(name='host')._load_config(source, 'host')
+    except IncludeLoopError, e:
+        eq_(e.args[0], ['a', 'b', 'c', 'a'])
+    else:
+        assert False, 'include loop was not detected'
+
+def test_self_include():
+    source = FakeSource({'a': dict(includes=['a'])})
+    assert_raises(IncludeLoopError, IncludeResolver(source).include, 'a')
@@ -0,0 +1,76 @@
+from nose.tools import *
+
+from ..vivarium import ActionContext
+from ..vivarium import Environment
+from ..vivarium import Host
+from ..vivarium import Target
+
+class FakeEnvironment(Environment):
+    def __init__(self, fail=()):
+        super(FakeEnvironment, self).__init__()
+        self.calls = []
+        self.fail = fail
+        self.forgotten = 0
+
+    def download_packages(self, packages):
+        self.calls.append(('download', list(packages)))
+        return dict((package, package not in self.fail)
+                    for package in packages)
+
+    def _install_packages(self, packages):
+        self.calls.append(('install', list(packages)))
+        return dict((package, package not in self.fail)
+                    for package in packages)
+
+    def forget_owners(self):
+        self.forgotten += 1
+
+def _target(*package_lists):
+    steps = [dict(action='install',
+                  parameters=dict(packages=packages),
+                  data={})
+             for packages in package_lists]
+    return Target().from_spawn(steps, None, {})
+
+def _plant(es, name, target):
+    for step in target.steps:
+        ctxt = ActionContext(
+            es, name, step.number, step.parameters, step.data, {}, None)
+        step.action_impl.sow(ctxt)
+        step.action_impl.plant(ctxt)
+
+def test_stage_packages_are_batched():
+    es = FakeEnvironment()
+    stage = {
+        'one': _target(['apache2', 'postfix'], ['mailutils']),
+        'two': _target(['postfix', 'ntp']),
+        }
+    Host._prepare_stage(stage, es)
+    packages = ['apache2', 'postfix', 'mailutils', 'ntp']
+    eq_(es.calls, [('download', packages)])
+    for name in sorted(stage):
+        _plant(es, name, stage[name])
+    eq_(es.calls, [('download', packages),
+                   ('install', ['apache2', 'postfix', 'ntp']),
+                   ('install', ['mailutils'])])
+    eq_(es.forgotten, 2)
+
+def test_later_steps_install_in_order():
+    es = FakeEnvironment()
+    target = _target(['early'], ['late'])
+    Host._prepare_stage({'one': target}, es)
+    step = target.steps[0]
+    ctxt = ActionContext(
+        es, 'one', step.number, step.parameters, step.data, {}, None)
+    step.action_impl.plant(ctxt)
+    eq_(es.calls, [('download', ['early', 'late']), ('install', ['early'])])
+
+def test_unprepared_step_is_batched():
+    es = FakeEnvironment(fail=['ntp'])
+    target = _target(['postfix', 'ntp'])
+    _plant(es, 'one', target)
+    eq_(es.calls, [('download', ['postfix', 'ntp']),
+                   ('install', ['postfix', 'ntp'])])
+    eq_(target.steps[0].action_impl._installed,
+        {'postfix': True, 'ntp': False})
+    eq_(es.forgotten, 1)
@@ -0,0 +1,105 @@
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from ..vivarium import JailWorker
+
+class Counter(object):
+    def __init__(self):
+        self.count = 0
+
+def _listdir(dirname):
+    return sorted(os.listdir(dirname))
+
+def _bump(counter):
+    counter.count += 1
+    return counter.count
+
+def _fail(message):
+    raise ValueError, message
+
+def _count(counter):
+    return counter.count
+
+def _unpicklable():
+    return lambda: None
+
+def _die():
+    os._exit(1)
+
+def _pid_after(delay):
+    time.sleep(delay)
+    return os.getpid()
+
+root = None
+worker = None
+counter = None
+
+def setup():
+    global root, worker, counter
+    if os.getuid() != 0:
+        raise SkipTest, 'chroot needs root'
+    root = tempfile.mkdtemp()
+    open(os.path.join(root, 'jailed'), 'w').close()
+    counter = Counter()
+    worker = JailWorker(root, {'counter': counter})
+    worker.start()
+
+def teardown():
+    if worker is not None:
+        worker.close()
+    if root is not None:
+        shutil.rmtree(root)
+
+def test_work_runs_in_jail():
+    eq_(worker.call(_listdir, '/'), ['jailed'])
+    assert 'jailed' not in os.listdir('/')
+
+def test_resident_state_stays_in_child():
+    first = worker.call(_bump, counter)
+    eq_(worker.call(_bump, counter), first + 1)
+    eq_(counter.count, 0)
+
+def test_errors_are_raised():
+    assert_raises(ValueError, worker.call, _fail, 'boom')
+    eq_(worker.call(_listdir, '/'), ['jailed'])
+
+def test_unpicklable_request_and_reply():
+    assert_raises(pickle.PicklingError, worker.call, _listdir, lambda: 0)
+    assert_raises(RuntimeError, worker.call, _unpicklable)
+    eq_(worker.call(_listdir, '/'), ['jailed'])
+
+def test_dead_child_is_replaced():
+    assert_raises(EOFError, worker.call, _die)
+    eq_(worker.call(_listdir, '/'), ['jailed'])
+
+def test_calls_run_in_parallel():
+    pool = JailWorker(root, size=2)
+    try:
+        pool.start()
+        pids = []
+        def call():
+            pids.append(pool.call(_pid_after, 0.2))
+        threads = [threading.Thread(target=call) for count in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(len(set(pids)), 2)
+    finally:
+        pool.close()
+
+def test_broadcast_reaches_every_child():
+    shared = Counter()
+    pool = JailWorker(root, {'shared': shared}, size=2)
+    try:
+        pool.start()
+        pool.broadcast(_bump, shared)
+        eq_([pool.call(_count, shared) for count in range(2)], [1, 1])
+    finally:
+        pool.close()
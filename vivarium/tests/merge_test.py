@@ -27,3 +27,36 @@ def test_merge():
     assert merged['c']['cd']['cda']['cdab'] == 'u3412'
     assert merged['g'] == 7
     assert merged['h']['i'] == 'u4321'
+
+def test_merge_shares_values():
+    packages = ['apache2', 'postfix']
+    lesser = dict(packages=packages, vhosts=dict(www=dict(port=80)))
+    merged = merge(lesser, dict(vhosts=dict(mail=dict(port=25))))
+    assert merged['packages'] is packages
+    assert sorted(merged['vhosts']) == ['mail', 'www']
+
+def test_merge_greater_replaces_non_dict():
+    merged = merge(dict(a=dict(b=1)), dict(a=2))
+    assert merged['a'] == 2
+    merged = merge(dict(a=2), dict(a=dict(b=1)))
+    assert merged['a'] == dict(b=1)
+    merged = merge(merge(dict(a=dict(b=1)), dict(a=2)), dict(a=dict(c=3)))
+    assert merged['a'] == dict(c=3)
+
+def test_merge_is_read_only():
+    merged = merge(dict(a=1), dict(b=2))
+    try:
+        merged['c'] = 3
+    except TypeError:
+        pass
+    else:
+        assert False, 'merged dict accepted an assignment'
+
+def test_merge_dumps_flat():
+    from ..humusfs import yamlio
+    shared = dict(x=1)
+    merged = merge(dict(a=shared, c=dict(d=1)), dict(b=shared, c=dict(e=2)))
+    text = yamlio.dump(merged)
+    assert '&' not in text and '*' not in text
+    assert yamlio.load(text) == dict(a=dict(x=1), b=dict(x=1),
+                                     c=dict(d=1, e=2))
@@ -0,0 +1,307 @@
+from nose.tools import *
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from ..vivarium import CircularDependencyError
+from ..vivarium import Host
+from ..vivarium import Target
+from ..vivarium import UnknownTargetError
+from ..vivarium import _critical_path
+
+class FakeTarget(object):
+    def __init__(self, planted, fail=False):
+        self.planted = planted
+        self.fail = fail
+        self.complete = True
+        self.depends = None
+        self.steps = []
+        self.version = 1
+
+    def merged_env(self, default_env, memo=None):
+        return default_env
+
+    def digest(self, env):
+        return str(self.version)
+
+    def plant(self, name, es, default_env, args):
+        for count in range(3):
+            print("{0} {1}".format(name, count))
+            time.sleep(0.01)
+        if self.fail:
+            raise RuntimeError, name
+        self.planted.append((name, threading.current_thread()))
+        return self.complete
+
+class FakeAction(object):
+    def __init__(self, planted):
+        self.planted = planted
+
+    def prepare(self, es, steps):
+        self.planted.append(('prepare', len(steps)))
+
+class FakeStep(object):
+    def __init__(self, planted):
+        self.action_name = 'fake'
+        self.action_impl = FakeAction(planted)
+
+def _plant(stages, jobs):
+    host = Host(name='www.example.com')
+    host.stages = stages
+    host.plant(None, {}, argparse.Namespace(jobs=jobs))
+
+def test_plant_stage_concurrently():
+    planted = []
+    stages = [
+        dict((name, FakeTarget(planted)) for name in 'abcd'),
+        {'e': FakeTarget(planted)}]
+    _plant(stages, 4)
+    eq_(sorted(name for name, thread in planted[:4]), list('abcd'))
+    eq_(planted[4][0], 'e')
+    assert len(set(thread for name, thread in planted[:4])) > 1
+
+def test_plant_failure_stops_later_stages():
+    planted = []
+    stages = [
+        {'a': FakeTarget(planted), 'b': FakeTarget(planted, fail=True)},
+        {'c': FakeTarget(planted)}]
+    assert_raises(RuntimeError, _plant, stages, 2)
+    eq_([name for name, thread in planted], ['a'])
+    assert not hasattr(sys.stdout, 'capture')
+
+def test_critical_path_priority():
+    deps = {'a': set(), 'b': set(), 'c': set(['a']), 'd': set(['c'])}
+    durations = {'a': 1.0, 'b': 5.0, 'c': 1.0, 'd': 1.0}
+    priority, dependents = _critical_path(deps, durations)
+    eq_(priority['d'], 1.0)
+    eq_(priority['a'], 3.0)
+    eq_(priority['b'], 5.0)
+    eq_(dependents['a'], set(['c']))
+
+def test_critical_path_detects_cycles():
+    deps = {'a': set(['b']), 'b': set(['a'])}
+    assert_raises(CircularDependencyError, _critical_path, deps, {})
+
+def test_plant_critical_path():
+    planted = []
+    targets = {
+        'slow': FakeTarget(planted),
+        'fast': FakeTarget(planted),
+        'after-fast': FakeTarget(planted),
+        }
+    targets['after-fast'].depends = ['fast']
+    stage_dir = tempfile.mkdtemp()
+    try:
+        host = Host(name='www.example.com')
+        host.stages = [
+            {'slow': targets['slow'], 'fast': targets['fast']},
+            {'after-fast': targets['after-fast']}]
+        args = argparse.Namespace(
+            jobs=2, schedule='critical-path', stage_dir=stage_dir)
+        host.plant(None, {}, args)
+        eq_(sorted(name for name, thread in planted),
+            ['after-fast', 'fast', 'slow'])
+        durations = host._load_durations(args)
+        eq_(sorted(durations.keys()), ['after-fast', 'fast', 'slow'])
+    finally:
+        shutil.rmtree(stage_dir)
+
+class Interrupted(BaseException):
+    pass
+
+class InterruptedTarget(FakeTarget):
+    def plant(self, name, es, default_env, args):
+        raise Interrupted, name
+
+def test_critical_path_reports_base_exceptions():
+    stage_dir = tempfile.mkdtemp()
+    try:
+        host = Host(name='www.example.com')
+        host.stages = [dict(one=InterruptedTarget([]))]
+        args = argparse.Namespace(
+            jobs=2, schedule='critical-path', stage_dir=stage_dir)
+        assert_raises(Interrupted, host.plant, None, {}, args)
+    finally:
+        shutil.rmtree(stage_dir)
+
+def test_durations_are_kept_inside_the_root():
+    root_dir = tempfile.mkdtemp()
+    try:
+        host = Host(name='www.example.com')
+        args = argparse.Namespace(root_dir=root_dir, stage_dir='/stage')
+        host._store_durations(args, {'a': 1.0})
+        eq_(host._durations_filename(args),
+            os.path.join(root_dir, 'stage', 'www.example.com.durations'))
+        eq_(host._load_durations(args), {'a': 1.0})
+        # A stage dir which cannot be made is reported, not raised.
+        with open(os.path.join(root_dir, 'file'), 'w'):
+            pass
+        args.stage_dir = '/file/stage'
+        host._store_durations(args, {'a': 1.0})
+    finally:
+        shutil.rmtree(root_dir)
+
+def test_critical_path_prepares_each_target():
+    planted = []
+    target = FakeTarget(planted)
+    target.steps = [FakeStep(planted), FakeStep(planted)]
+    stage_dir = tempfile.mkdtemp()
+    try:
+        host = Host(name='www.example.com')
+        host.stages = [dict(one=target)]
+        args = argparse.Namespace(
+            jobs=1, schedule='critical-path', stage_dir=stage_dir)
+        host.plant(None, {}, args)
+        eq_([event[0] for event in planted], ['prepare', 'one'])
+        eq_(planted[0], ('prepare', 2))
+    finally:
+        shutil.rmtree(stage_dir)
+
+def test_env_merged_once_per_target():
+    default_env = dict(HOST=dict(FQDN='www.example.com'))
+    target = Target().from_spawn([], None, dict(port=80))
+    env = target.merged_env(default_env)
+    eq_(env['port'], 80)
+    eq_(env['HOST']['FQDN'], 'www.example.com')
+    assert target.merged_env(default_env) is env
+    assert target.merged_env(dict(default_env)) is not env
+
+def test_equal_envs_are_shared():
+    default_env = dict(HOST=dict(FQDN='www.example.com'))
+    one = Target().from_spawn([], None, dict(vhosts=['a', 'b']))
+    two = Target().from_spawn([], None, dict(vhosts=['a', 'b']))
+    three = Target().from_spawn([], None, dict(vhosts=['c']))
+    host = Host(name='www.example.com')
+    host.stages = [dict(one=one, two=two), dict(three=three)]
+    host.plant(None, default_env, argparse.Namespace(jobs=1))
+    assert one.merged_env(default_env) is two.merged_env(default_env)
+    assert one.merged_env(default_env) is not three.merged_env(default_env)
+
+def test_envs_of_equal_values_of_other_types_are_not_shared():
+    default_env = dict(HOST=dict(FQDN='www.example.com'))
+    envs = [dict(debug=1), dict(debug=True), dict(debug=1.0),
+            dict(name='x'), dict(name=u'x')]
+    targets = [Target().from_spawn([], None, env) for env in envs]
+    memo = {}
+    merged = [target.merged_env(default_env, memo) for target in targets]
+    eq_([env.get('debug', env.get('name')) for env in merged],
+        [1, True, 1.0, 'x', u'x'])
+    eq_([type(env.get('debug', env.get('name'))) for env in merged],
+        [int, bool, float, str, unicode])
+
+def _selection_host():
+    planted = []
+    targets = dict((name, FakeTarget(planted)) for name in 'abcde')
+    targets['c'].depends = ['a']
+    targets['d'].depends = ['c', 'b']
+    targets['e'].depends = ['b']
+    host = Host(name='www.example.com')
+    host.stages = [
+        dict((name, targets[name]) for name in 'ab'),
+        dict((name, targets[name]) for name in 'ce'),
+        dict(d=targets['d'])]
+    return host
+
+def _stage_names(host):
+    return [sorted(stage) for stage in host.stages]
+
+def test_select_targets_with_depends():
+    host = _selection_host().select_targets(['c'])
+    eq_(_stage_names(host), [['a'], ['c']])
+    host = _selection_host().select_targets(['d'])
+    eq_(_stage_names(host), [['a', 'b'], ['c'], ['d']])
+    host = _selection_host().select_targets(['c', 'e'])
+    eq_(_stage_names(host), [['a', 'b'], ['c', 'e']])
+
+def test_select_targets_with_dependents():
+    host = _selection_host().select_targets(['c'], dependents=True)
+    eq_(_stage_names(host), [['a'], ['c'], ['d']])
+    host = _selection_host().select_targets(['b'], dependents=True)
+    eq_(_stage_names(host), [['b'], ['e'], ['d']])
+
+def test_select_unknown_target():
+    assert_raises(UnknownTargetError,
+                  _selection_host().select_targets, ['nope'])
+
+def _journal_plant(host, stage_dir, **kwargs):
+    args = argparse.Namespace(jobs=1, stage_dir=stage_dir, **kwargs)
+    host.plant(None, {}, args)
+
+def test_journal_skips_planted_targets():
+    stage_dir = tempfile.mkdtemp()
+    try:
+        planted = []
+        targets = dict((name, FakeTarget(planted)) for name in 'ab')
+        host = Host(name='www.example.com')
+        host.stages = [dict(a=targets['a']), dict(b=targets['b'])]
+        _journal_plant(host, stage_dir)
+        eq_(sorted(name for name, thread in planted), ['a', 'b'])
+        del planted[:]
+        targets['b'].version = 2
+        host.stages = [dict(a=targets['a']), dict(b=targets['b'])]
+        _journal_plant(host, stage_dir)
+        eq_([name for name, thread in planted], ['b'])
+        del planted[:]
+        host.stages = [dict(a=targets['a']), dict(b=targets['b'])]
+        _journal_plant(host, stage_dir, force=True)
+        eq_(sorted(name for name, thread in planted), ['a', 'b'])
+    finally:
+        shutil.rmtree(stage_dir)
+
+def test_journal_resumes_after_failure():
+    stage_dir = tempfile.mkdtemp()
+    try:
+        planted = []
+        targets = dict((name, FakeTarget(planted)) for name in 'ab')
+        targets['b'].fail = True
+        host = Host(name='www.example.com')
+        host.stages = [dict(a=targets['a']), dict(b=targets['b'])]
+        assert_raises(RuntimeError, _journal_plant, host, stage_dir)
+        del planted[:]
+        targets['b'].fail = False
+        host.stages = [dict(a=targets['a']), dict(b=targets['b'])]
+        _journal_plant(host, stage_dir)
+        eq_([name for name, thread in planted], ['b'])
+    finally:
+        shutil.rmtree(stage_dir)
+
+def test_journal_replants_incomplete_targets():
+    stage_dir = tempfile.mkdtemp()
+    try:
+        planted = []
+        targets = dict((name, FakeTarget(planted)) for name in 'ab')
+        targets['b'].complete = False
+        host = Host(name='www.example.com')
+        host.stages = [dict(a=targets['a']), dict(b=targets['b'])]
+        _journal_plant(host, stage_dir)
+        del planted[:]
+        host.stages = [dict(a=targets['a']), dict(b=targets['b'])]
+        _journal_plant(host, stage_dir)
+        eq_([name for name, thread in planted], ['b'])
+    finally:
+        shutil.rmtree(stage_dir)
+
+def test_journal_is_kept_inside_the_root():
+    root_dir = tempfile.mkdtemp()
+    try:
+        planted = []
+        host = Host(name='www.example.com')
+        host.stages = [dict(a=FakeTarget(planted))]
+        _journal_plant(host, '/stage', root_dir=root_dir)
+        ok_(os.path.exists(os.path.join(
+            root_dir, 'stage', 'www.example.com.journal')))
+    finally:
+        shutil.rmtree(root_dir)
+
+def test_target_digest_covers_seed_and_env():
+    steps = [dict(action='install', parameters={}, data={})]
+    one = Target().from_spawn(steps, None, dict(port=80))
+    two = Target().from_spawn(steps, None, dict(port=80))
+    eq_(one.digest(dict(port=80)), two.digest(dict(port=80)))
+    assert one.digest(dict(port=80)) != one.digest(dict(port=81))
+    three = Target().from_spawn(steps, ['one'], dict(port=80))
+    assert one.digest(dict(port=80)) != three.digest(dict(port=80))
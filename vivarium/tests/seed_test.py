@@ -0,0 +1,212 @@
+from nose.tools import *
+import argparse
+import os.path
+import shutil
+import tempfile
+
+from ..humus import CachedHumus
+from ..humus import Humus
+from ..humusfs import yamlio
+from ..vivarium import BlobError
+from ..vivarium import BlobStore
+from ..vivarium import Host
+from ..vivarium import _file_seeds
+from ..vivarium import _is_seed_stale
+from ..vivarium import _seed_host
+from ..vivarium import _seed_hostnames
+from ..vivarium import _seed_in_pool
+from ..vivarium import seed
+
+source = None
+
+def setup():
+    global source
+    filename = os.path.join(os.path.dirname(__file__), 'hosts.yaml')
+    source = CachedHumus(filename)
+
+def _args(**kwargs):
+    defaults = dict(host=None, stdout=False)
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+def test_single_host():
+    eq_(_seed_hostnames(source, _args(host='www.example.com')),
+        ['www.example.com'])
+
+def test_all_hosts():
+    eq_(len(_seed_hostnames(source, _args(host='*'))), 3)
+
+def test_glob_hosts():
+    eq_(_seed_hostnames(source, _args(host='*.example.com')),
+        ['mail.example.com', 'www.example.com'])
+
+def test_seed_host():
+    hostname, result, inputs, blobs, error = _seed_host(
+        'www.example.com', source, _args())
+    eq_(hostname, 'www.example.com')
+    eq_(error, None)
+    assert 'name: www.example.com' in result
+
+def test_seed_host_failure_is_returned():
+    hostname, result, inputs, blobs, error = _seed_host(
+        'no.such.host', source, _args())
+    eq_(result, None)
+    assert error is not None
+
+def test_seed_in_pool():
+    hostnames = ['www.example.com', 'no.such.host', 'db.example.org']
+    results = list(_seed_in_pool(hostnames, source, _args(), 2))
+    eq_(sorted(result[0] for result in results), sorted(hostnames))
+    failed = [result[0] for result in results if result[4] is not None]
+    eq_(failed, ['no.such.host'])
+
+def test_seed_in_pool_parses_shared_source_before_forking():
+    filename = os.path.join(os.path.dirname(__file__), 'hosts.yaml')
+    fresh = CachedHumus(filename)
+    hostnames = ['www.example.com', 'mail.example.com']
+    results = _seed_in_pool(hostnames, fresh, _args(), 2)
+    eq_(next(results)[0], 'www.example.com')
+    assert '/roles/www' in fresh._loads
+    eq_([result[0] for result in results], ['mail.example.com'])
+
+def test_seed_host_records_inputs():
+    hostname, result, inputs, blobs, error = _seed_host(
+        'www.example.com', source, _args())
+    assert '/hosts/com/example/www' in inputs
+    assert '/roles/www' in inputs
+    assert '/includes/base' in inputs
+    assert '/contents/etc.motd' in inputs
+
+def _spawn_seed(tempdir, hostname, result, blobs):
+    filename = os.path.join(tempdir, 'spawn.yaml')
+    shutil.copy(os.path.join(os.path.dirname(__file__), 'hosts.yaml'),
+                filename)
+    spawn = Humus(filename)
+    with spawn.open(spawn.path_to_seed(hostname), 'w') as dest:
+        dest.write(result)
+    for digest, body in blobs.iteritems():
+        with spawn.open(spawn.path_to_blob(digest), 'w') as dest:
+            dest.write(body)
+    return filename
+
+def _seed_spawn(tempdir, hostname, **kwargs):
+    filename = os.path.join(tempdir, 'spawn.yaml')
+    if not os.path.exists(filename):
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'hosts.yaml'),
+                    filename)
+    seed(_args(spawn=filename, source=None, host=hostname, changed=True,
+               **kwargs))
+    return Humus(filename)
+
+def test_seed_is_stale_in_another_format():
+    tempdir = tempfile.mkdtemp()
+    try:
+        hostname = 'www.example.com'
+        spawn = _seed_spawn(tempdir, hostname, seed_format='yaml')
+        eq_(_is_seed_stale(hostname, spawn, spawn, 'yaml'), False)
+        eq_(_is_seed_stale(hostname, spawn, spawn, 'binary'), True)
+        spawn = _seed_spawn(tempdir, hostname, seed_format='binary')
+        eq_(_is_seed_stale(hostname, spawn, spawn, 'binary'), False)
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_seed_is_stale_without_its_blobs():
+    tempdir = tempfile.mkdtemp()
+    try:
+        hostname = 'www.example.com'
+        spawn = _seed_spawn(tempdir, hostname)
+        eq_(_is_seed_stale(hostname, spawn, spawn), False)
+        filename = os.path.join(tempdir, 'spawn.yaml')
+        with open(filename) as spawn_file:
+            tree = yamlio.load(spawn_file)
+        digest = sorted(tree['blobs'])[0]
+        del tree['blobs'][digest]
+        with open(filename, 'w') as spawn_file:
+            yamlio.dump(tree, spawn_file)
+        spawn = Humus(filename)
+        eq_(_is_seed_stale(hostname, spawn, spawn), True)
+        spawn = _seed_spawn(tempdir, hostname)
+        assert spawn.isfile(spawn.path_to_blob(digest))
+    finally:
+        shutil.rmtree(tempdir)
+
+def _motd(host):
+    step = host.stages[0]['motd'].steps[0]
+    return step.data['files']['etc.motd']
+
+def test_plant_reads_binary_seed():
+    hostname, result, inputs, blobs, error = _seed_host(
+        'www.example.com', source, _args(seed_format='binary'))
+    eq_(error, None)
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = _spawn_seed(tempdir, hostname, result, blobs)
+        host = Host(name=hostname).from_spawn(Humus(filename))
+        eq_(sorted(host.roles), ['www'])
+        eq_(sorted(host.stages[0]), ['motd'])
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_seed_moves_bodies_to_blobs():
+    hostname, result, inputs, blobs, error = _seed_host(
+        'www.example.com', source, _args())
+    eq_(error, None)
+    assert blobs
+    for file_seed in _file_seeds(yamlio.load(result)):
+        assert 'content' not in file_seed and 'template' not in file_seed
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = _spawn_seed(tempdir, hostname, result, blobs)
+        host = Host(name=hostname).from_spawn(Humus(filename))
+        inline = _motd(Host(name=hostname).from_source(source))
+        eq_(_motd(host), inline)
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_blob_store_caches():
+    hostname, result, inputs, blobs, error = _seed_host(
+        'www.example.com', source, _args())
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = _spawn_seed(tempdir, hostname, result, blobs)
+        cache_dir = os.path.join(tempdir, 'cache')
+        digest, body = blobs.items()[0]
+        eq_(BlobStore(Humus(filename), cache_dir).get(digest), body)
+        assert os.path.isfile(os.path.join(cache_dir, digest))
+        # A later plant is served from the cache alone.
+        empty = os.path.join(tempdir, 'empty.yaml')
+        eq_(BlobStore(Humus(empty), cache_dir).get(digest), body)
+        # Nothing is held in memory, a damaged cache entry is fetched
+        # again from the spawn.
+        store = BlobStore(Humus(filename), cache_dir)
+        eq_(store.get(digest), body)
+        with open(os.path.join(cache_dir, digest), 'w') as cached:
+            cached.write('damaged')
+        eq_(store.get(digest), body)
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_blob_store_rejects_corrupt_blob():
+    tempdir = tempfile.mkdtemp()
+    try:
+        spawn = Humus(os.path.join(tempdir, 'spawn.yaml'))
+        digest = '0' * 64
+        with spawn.open(spawn.path_to_blob(digest), 'w') as dest:
+            dest.write('not the right body')
+        assert_raises(BlobError, BlobStore(spawn).get, digest)
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_steps_are_decoded_when_reached():
+    hostname, result, inputs, blobs, error = _seed_host(
+        'www.example.com', source, _args(seed_format='binary'))
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = _spawn_seed(tempdir, hostname, result, blobs)
+        target = Host(name=hostname).from_spawn(Humus(filename)).stages[0][
+            'motd']
+        eq_(target._steps, None)
+        eq_(target.steps[0].action_name, 'install')
+        assert target._steps is not None
+    finally:
+        shutil.rmtree(tempdir)
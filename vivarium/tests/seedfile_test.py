@@ -0,0 +1,75 @@
+from nose.tools import *
+import mmap
+import os.path
+import shutil
+import tempfile
+
+from .. import seedfile
+from ..humusfs.fsfs import FSFS
+from ..vivarium import _merge_dicts
+
+seed = {
+    'name': 'www.example.com',
+    'config': _merge_dicts(dict(env=dict(port=80)), dict(roles={'www': None})),
+    'stages': [{'motd': {
+        'depends': None,
+        'env': {'greeting': u'h\xe9llo'},
+        'steps': [{'action': 'install',
+                   'data': {'files': {'etc.motd': {
+                       'location': '/etc/motd',
+                       'content': 'welcome\n' * 100,
+                       'mode_bits': 0644}}}}]}}],
+    }
+
+def test_binary_round_trip():
+    data = seedfile.dump(seed, 'binary')
+    assert seedfile.is_binary(data)
+    loaded = seedfile.load(data)
+    eq_(loaded, seedfile.load(seedfile.dump(seed, 'yaml')))
+    files = loaded['stages'][0]['motd']['steps'][0]['data']['files']
+    eq_(files['etc.motd']['content'], 'welcome\n' * 100)
+
+def test_content_is_a_length_prefixed_blob():
+    data = seedfile.dump(seed, 'binary')
+    content = 'welcome\n' * 100
+    offset = data.index(content)
+    eq_(seedfile._LENGTH.unpack_from(data, offset - 8)[0], len(content))
+
+def test_yaml_is_not_binary():
+    data = seedfile.dump(seed, 'yaml')
+    assert not seedfile.is_binary(data)
+    eq_(seedfile.load(data)['name'], 'www.example.com')
+
+def test_unknown_version():
+    data = seedfile.dump(seed, 'binary')
+    data = data[:7] + chr(seedfile.VERSION + 1) + data[8:]
+    assert_raises(seedfile.SeedFormatError, seedfile.load, data)
+
+def test_unknown_format():
+    assert_raises(seedfile.SeedFormatError, seedfile.dump, seed, 'xml')
+
+def test_lazy_load():
+    data = seedfile.dump(seed, 'binary')
+    lazy = seedfile.load(data, lazy=True)
+    assert not isinstance(lazy, dict)
+    step = lazy['stages'][0]['motd']['steps'][0]
+    eq_(step['data']['files']['etc.motd']['content'], 'welcome\n' * 100)
+    eq_(seedfile.thaw(lazy), seedfile.load(data))
+
+def test_lazy_load_mapped_file():
+    tempdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tempdir, 'seed'), 'wb') as dest:
+            dest.write(seedfile.dump(seed, 'binary'))
+        data = FSFS(tempdir).map('/seed')
+        assert isinstance(data, mmap.mmap)
+        lazy = seedfile.load(data, lazy=True)
+        eq_(lazy['name'], 'www.example.com')
+        eq_(seedfile.thaw(lazy['stages'][0]['motd']['env']),
+            {'greeting': u'h\xe9llo'})
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_lazy_load_of_yaml_is_plain():
+    loaded = seedfile.load(seedfile.dump(seed, 'yaml'), lazy=True)
+    eq_(loaded['name'], 'www.example.com')
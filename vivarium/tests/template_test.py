@@ -0,0 +1,55 @@
+from nose.tools import *
+import os
+import shutil
+import tempfile
+
+from ..vivarium import TemplateCache
+
+def test_compiled_once():
+    source = 'hello ${name}'
+    klass = TemplateCache().template_class(source)
+    assert klass is TemplateCache().template_class(source)
+
+def test_render():
+    tpl = TemplateCache().template('hello ${name}', {'name': 'world'})
+    eq_(str(tpl), 'hello world')
+
+def test_disk_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        source = 'disk ${name}'
+        klass = TemplateCache._compile(source, 'abc', cache_dir)
+        eq_(os.listdir(cache_dir), ['template_abc.py'])
+        eq_(str(klass(searchList=[{'name': 'cache'}])), 'disk cache')
+        cached = os.stat(os.path.join(cache_dir, 'template_abc.py'))
+        klass = TemplateCache._compile(source, 'abc', cache_dir)
+        eq_(str(klass(searchList=[{'name': 'reuse'}])), 'disk reuse')
+        eq_(os.stat(os.path.join(cache_dir, 'template_abc.py')).st_ino,
+            cached.st_ino)
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_disk_cache_of_other_source_is_recompiled():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        TemplateCache._compile('first ${name}', 'abc', cache_dir)
+        klass = TemplateCache._compile('second ${name}', 'abc', cache_dir)
+        eq_(str(klass(searchList=[{'name': 'one'}])), 'second one')
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_disk_cache_writable_by_others_is_ignored():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        source = 'shared ${name}'
+        TemplateCache._compile(source, 'abc', cache_dir)
+        filename = os.path.join(cache_dir, 'template_abc.py')
+        with open(filename) as module_file:
+            code = module_file.read()
+        with open(filename, 'w') as module_file:
+            module_file.write(code.replace('shared', 'tampered'))
+        os.chmod(filename, 0666)
+        klass = TemplateCache._compile(source, 'abc', cache_dir)
+        eq_(str(klass(searchList=[{'name': 'one'}])), 'shared one')
+    finally:
+        shutil.rmtree(cache_dir)
@@ -1,14 +1,36 @@
 from Cheetah.Template import Template
+from Cheetah.Version import Version as CheetahVersion
+import collections
+import contextlib
 from copy import deepcopy
+import cPickle as pickle
+import cStringIO as stringio
 import errno
+import filecmp
+import fnmatch
 import grp
+import hashlib
+import heapq
+import multiprocessing
+import multiprocessing.pool
 import os.path
 import pwd
+import Queue
 import shutil
+import stat
+import subprocess
 import sys
-import yaml
+import tempfile
+import threading
+import time
+import traceback
+import types
 
+import filecopy
 import humus
+import seedfile
+import humusfs.safeio as safeio
+import humusfs.yamlio as yamlio
 
 class IncludeLoopError(Exception):
     pass
@@ -19,36 +41,88 @@ class CircularDependencyError(Exception):
 class TargetCollisionError(Exception):
     pass
 
+class UnknownTargetError(Exception):
+    pass
+
 class HostMismatch(Exception):
     pass
 
+class UnknownOwnerError(Exception):
+    pass
+
 class BadFilename(Exception):
     pass
 
+class BadMode(Exception):
+    pass
+
+class BlobError(Exception):
+    pass
+
+class SeedError(Exception):
+    pass
+
+class IncludeResolver(object):
+    """
+    Resolves the includes of configs from ``source``. Each include is
+    loaded and merged with everything it includes once, however many
+    paths lead to it, and the result is shared through
+    ``source.memoize`` with every other resolver of the same source.
+
+    ``graph`` is the include DAG seen so far, mapping each include to
+    the includes it names directly.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.graph = {}
+        # Include name to its resolved config and include DAG.
+        self._memo = {}
+
+    def resolve(self, config, chain=()):
+        """
+        Returns ``config`` merged over everything it includes.
+        ``chain`` is the includes being resolved which led to it.
+        """
+        if config is None:
+            return None
+        for include in config.get('includes', []):
+            config = _merge_dicts(self.include(include, chain), config)
+        return config
+
+    def include(self, name, chain=()):
+        "Returns the fully resolved config of include ``name``."
+        if name in chain:
+            raise IncludeLoopError, list(chain) + [name]
+        if name not in self._memo:
+            self._memo[name] = self.source.memoize(
+                ('include', name),
+                lambda: self._load_include(name, chain))
+        resolved, graph = self._memo[name]
+        self.graph.update(graph)
+        return resolved
+
+    def _load_include(self, name, chain):
+        config = self.source.load(self.source.path_to_include(name)) or {}
+        resolver = IncludeResolver(self.source)
+        resolver._memo = self._memo
+        resolver.graph[name] = list(config.get('includes', []))
+        resolved = resolver.resolve(config, chain + (name,))
+        return resolved, resolver.graph
+
 class Entity(object):
     def __init__(self, *args, **kwargs):
         # print("Entity init {0}".format(kwargs))
         self.name = kwargs['name']
         self._config = None
+        # Include DAG of the config, see IncludeResolver.graph.
+        self.include_graph = {}
 
-    def _load_config(self, source, configfile):
-        self._load_config_checked(source, configfile, set())
+    def _load_config(self, source, filename):
+        resolver = IncludeResolver(source)
+        self._config = resolver.resolve(source.load(filename))
+        self.include_graph = resolver.graph
         if self._config is None: self._config = {}
 
-    def _load_config_checked(self, source, configfile, seen):
-        self._config = yaml.load(configfile.read())
-        includes = self._config.get('includes', [])
-        # print("includes: {0}".format(includes))
-        for include in includes:
-            if include in seen: raise IncludeLoopError, seen
-            seen.add(include)
-            entity = Entity(name=include)
-            with source.open(source.path_to_include(include)) as includefile:
-                entity._load_config(source, includefile)
-            # print("config: {0}".format(entity._config))
-            self._config = _merge_dicts(entity._config, self._config)
-            seen.remove(include)
-
 class Enum(set):
     """
     Simple class to represent an enumeration. Really just a
@@ -67,6 +141,15 @@ class Enum(set):
 
 class File(object):
     IS = Enum(['regular', 'dir', 'sym', 'hard', 'absent'])
+    # Regular files up to this many bytes are sown in memory.
+    MEMORY_THRESHOLD = 64 * 1024
+    # Every permission bit chmod can set.
+    ALL_MODE_BITS = 07777
+    _WHO_BITS = {'u': 04700, 'g': 02070, 'o': 01007, 'a': 07777}
+    _PERM_BITS = {'r': 0444, 'w': 0222, 'x': 0111, 's': 06000, 't': 01000}
+    _CLASS_SHIFT = {'u': 6, 'g': 3, 'o': 0}
+    # Seed keys which may hold a file body.
+    _BODIES = ['template', 'content']
 
     def __init__(self):
         self.location = None
@@ -74,6 +157,10 @@ class File(object):
         self.owner = None
         self.group = None
         self.mode = None
+        # The mode compiled at seed time. Only the bits in mode_mask
+        # are set, the rest are left as they are on the host.
+        self.mode_bits = None
+        self.mode_mask = File.ALL_MODE_BITS
 
         # *TODO consider only defining these in sub-classes.
         self._template = None
@@ -82,8 +169,7 @@ class File(object):
         self._files = None
 
     def from_source(self, source, filename):
-        with source.open(source.path_to_file(filename)) as file_def:
-            config = yaml.load(file_def.read())
+        config = source.load(source.path_to_file(filename))
         location = config['location']
         return self._load_config(config, source, location)
 
@@ -93,6 +179,12 @@ class File(object):
         self.owner = seed.get('owner', None)
         self.group = seed.get('group', None)
         self.mode = seed.get('mode', None)
+        if self.mode is not None:
+            # Seeds from before modes were compiled.
+            self._compile_mode()
+        else:
+            self.mode_bits = seed.get('mode_bits', None)
+            self.mode_mask = seed.get('mode_mask', File.ALL_MODE_BITS)
         if self.type == File.IS.regular:
             try:
                 self._template = seed['template']
@@ -104,7 +196,7 @@ class File(object):
             self._files = []
             for file_def in seed['files']:
                 self._files.append(File().from_seed(file_def))
-        elif self.type is File.absent:
+        elif self.type == File.IS.absent:
             pass
         else:
             msg = "Unkown file type: {0}"
@@ -119,8 +211,10 @@ class File(object):
             seed['owner'] = self.owner
         if self.group is not None:
             seed['group'] = self.group
-        if self.mode is not None:
-            seed['mode'] = self.mode
+        if self.mode_bits is not None:
+            seed['mode_bits'] = self.mode_bits
+            if self.mode_mask != File.ALL_MODE_BITS:
+                seed['mode_mask'] = self.mode_mask
         if self._template is not None:
             seed['template'] = self._template
         if self._content is not None:
@@ -133,103 +227,261 @@ class File(object):
                 seed['files'].append(node.to_seed())
         return seed
 
-    def sow(self, filename, ctxt):
+    @staticmethod
+    def extract_blobs(seed, blobs):
+        """
+        Move the body of the file in ``seed``, and of every file under
+        it, into ``blobs`` keyed by its sha256 digest. The seed is left
+        with the digest under ``template_blob`` or ``content_blob``.
+        """
+        for key in File._BODIES:
+            body = seed.pop(key, None)
+            if body is None:
+                continue
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            digest = hashlib.sha256(body).hexdigest()
+            blobs[digest] = body
+            seed[key + '_blob'] = digest
+        for child in seed.get('files', []):
+            File.extract_blobs(child, blobs)
+
+    @staticmethod
+    def resolve_blobs(seed, store):
+        """
+        Undo ``extract_blobs``, fetching each body from ``store``.
+        """
+        for key in File._BODIES:
+            digest = seed.pop(key + '_blob', None)
+            if digest is None:
+                continue
+            body = store.get(digest)
+            try:
+                body.decode('ascii')
+            except UnicodeDecodeError:
+                # Match what an inline body loaded from yaml would be.
+                try:
+                    body = body.decode('utf-8')
+                except UnicodeDecodeError:
+                    pass
+            seed[key] = body
+        for child in seed.get('files', []):
+            File.resolve_blobs(child, store)
+
+    def sow(self, filename, ctxt, in_memory=True):
+        """
+        Prepare this node at ``filename`` in the stage dir so that
+        ``plant`` can move it into place. Regular files no larger than
+        ``memory_threshold`` from the arguments are kept in ``ctxt``
+        instead unless ``in_memory`` is false, as it is for the
+        contents of a directory.
+        """
         if self.type == File.IS.regular:
-            self._sow_regular(filename, ctxt)
+            self._sow_regular(filename, ctxt, in_memory)
         elif self.type == File.IS.dir:
             self._sow_dir(filename, ctxt)
+        elif self.type == File.IS.sym:
+            self._sow_sym(filename, ctxt)
 
     def plant(self, src_filename, dst_filename, ctxt):
-        def _remove(name):
-            if os.path.islink(name) or os.path.isfile(name):
-                os.unlink(name)
-            elif os.path.isdir(name):
-                shutil.rmtree(name)
-            elif os.path.exists(name):
-                msg = "Path is unknown type: {0}"
-                raise RuntimeError, msg.format(name)
-        def _finalize_file(location, uid, gid, mode):
-            # print("finalize file {0}".format(location))
-            if uid > -1 or gid > -1:
-                os.chown(location, uid, gid)
-            if mode is not None:
-                os.chmod(location, mode)
-        def _finalize_link(location, uid, gid, mode):
-            # print("finalize link {0}".format(location))
-            if uid > -1 or gid > -1:
-                os.lchown(location, uid, gid)
-            if mode is not None:
-                os.lchmod(location, mode)
-        def _inner_plant(node):
-            uid, gid = node._uid_gid_owner()
-            mode = node._file_mode()
-            if node.type == File.IS.regular:
-                _finalize_file(node.location, uid, gid, mode)
-            elif node.type == File.IS.dir:
-                for vvfile in node._files:
-                    _inner_plant(vvfile)
-                _finalize_file(node.location, uid, gid, mode)
-                # fd = os.open(node.location, os.O_DIRECTORY | os.O_RDWR)
-                # node._chown(fd)
-                # node._chmod(fd)
-                # os.close(fd)
-            elif node.type == File.IS.sym:
-                os.symlink(node._target, node.location)
-                _finalize_link(node.location, uid, gid, mode)
-            elif node.type == File.IS.hard:
-                os.link(node._target, node.location)
-                _finalize_link(node.location, uid, gid, mode)
-            elif node.type == File.IS.absent:
-                _remove(node.location)
-        def _plant_dir(node, src_fname, dst_fname):
-            # print("remove dir: {0}".format(dst_fname)
-            _remove(dst_fname)
-            # print "copy dir: {0} {1}".format(src_fname, dst_fname))
-            shutil.copytree(src_fname, dst_fname, symlinks=True)
-            _inner_plant(node)
-        def _plant_file(node, src_fname, dst_fname):
-            with open(src_fname, 'rb') as src:
-                with open(dst_fname, 'wb') as dst:
-                    shutil.copyfileobj(src, dst)
-            uid, gid = node._uid_gid_owner()
-            mode = node._file_mode()
-            _finalize_file(node.location, uid, gid, mode)
+        """
+        Move the sown ``src_filename`` into place at ``dst_filename``
+        and set ownership and permissions. Returns a tuple of the
+        number of nodes changed and left unchanged.
+
+        A directory is reconciled entry by entry rather than replaced
+        wholesale: entries which already match what was sown are left
+        alone, extra entries are removed and each differing entry is
+        renamed into place, so the cost follows the size of the change.
+
+        When ``converge`` is set in the arguments a top level file
+        which already matches is also left alone, as is ownership or
+        permission which is already correct, so a converged host sees
+        no writes at all.
+        """
+        converge = getattr(ctxt.args, 'converge', False)
+        content = ctxt.sown.get(src_filename, None)
+        return ctxt.es.work(
+            _plant_node, self, src_filename, dst_filename, content,
+            converge, ctxt.owners)
+
+    def _matches(self, filename, location=None):
+        """
+        Returns ``True`` if the node at ``location``, by default
+        ``self.location``, already has the type and content of this
+        node as sown in ``filename``. Ownership and permissions are
+        not compared.
+        """
+        if location is None:
+            location = self.location
         if self.type == File.IS.regular:
-            ctxt.es.work(_plant_file, self, src_filename, dst_filename)
+            return os.path.isfile(location) \
+                and not os.path.islink(location) \
+                and filecmp.cmp(filename, location, shallow=False)
         elif self.type == File.IS.dir:
-            ctxt.es.work(_plant_dir, self, src_filename, dst_filename)
-        else:
-            ctxt.es.work(_inner_plant, self)
+            if os.path.islink(location) or not os.path.isdir(location):
+                return False
+            names = set(os.path.basename(node.location)
+                        for node in self._files
+                        if node.type != File.IS.absent)
+            if names != set(os.listdir(location)):
+                return False
+            for node in self._files:
+                name = os.path.basename(node.location)
+                if not node._matches(os.path.join(filename, name),
+                                     os.path.join(location, name)):
+                    return False
+            return True
+        elif self.type == File.IS.sym:
+            return File._is_link_to(location, self._target)
+        elif self.type == File.IS.hard:
+            return File._is_hard_link_to(location, self._target)
+        elif self.type == File.IS.absent:
+            return not os.path.lexists(location)
+        return False
+
+    @staticmethod
+    def _holds(location, content):
+        if not os.path.isfile(location) or os.path.islink(location):
+            return False
+        if os.path.getsize(location) != len(content):
+            return False
+        with open(location, 'rb') as existing:
+            return existing.read() == content
+
+    @staticmethod
+    def _temp_name(location):
+        dirname, basename = os.path.split(location)
+        return os.path.join(dirname, '.{0}.{1}'.format(
+            basename, os.urandom(4).encode('hex')))
+
+    @staticmethod
+    def _make_room(location):
+        # rename() will not replace a directory with anything else.
+        if os.path.isdir(location) and not os.path.islink(location):
+            shutil.rmtree(location)
+
+    @staticmethod
+    def _replace_file(src_filename, location):
+        """
+        Atomically replace ``location`` with the content of
+        ``src_filename`` using the cheapest copy strategy available,
+        which may consume ``src_filename``. An existing file keeps its
+        permissions and ownership, a new one gets those of
+        ``src_filename``.
+        """
+        src_mode = stat.S_IMODE(os.stat(src_filename).st_mode)
+        dirname, basename = os.path.split(location)
+        fd, temp = tempfile.mkstemp(prefix='.' + basename + '.', dir=dirname)
+        os.close(fd)
+        try:
+            filecopy.FileCopier().place(src_filename, temp)
+            File._rename_into_place(temp, location, src_mode)
+        except:
+            if os.path.lexists(temp):
+                os.unlink(temp)
+            raise
+
+    @staticmethod
+    def _write_file(content, location):
+        """
+        Atomically replace ``location`` with ``content``. An existing
+        file keeps its permissions and ownership, a new one is created
+        as ``open`` would create it.
+        """
+        while True:
+            temp = File._temp_name(location)
+            try:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+                fd = os.open(temp, flags, 0666)
+                break
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                output.write(content)
+            File._rename_into_place(temp, location, None)
+        except:
+            if os.path.lexists(temp):
+                os.unlink(temp)
+            raise
+
+    @staticmethod
+    def _rename_into_place(temp, location, mode):
+        if os.path.isfile(location) and not os.path.islink(location):
+            st = os.stat(location)
+            os.chmod(temp, stat.S_IMODE(st.st_mode))
+            tst = os.stat(temp)
+            if (st.st_uid, st.st_gid) != (tst.st_uid, tst.st_gid):
+                os.chown(temp, st.st_uid, st.st_gid)
+        elif mode is not None:
+            os.chmod(temp, mode)
+        File._make_room(location)
+        os.rename(temp, location)
+
+    @staticmethod
+    def _replace_link(make_link, target, location):
+        """
+        Atomically replace ``location`` with a link to ``target``
+        made by ``make_link``, which is ``os.symlink`` or ``os.link``.
+        """
+        while True:
+            temp = File._temp_name(location)
+            try:
+                make_link(target, temp)
+                break
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            File._make_room(location)
+            os.rename(temp, location)
+        except:
+            os.unlink(temp)
+            raise
+
+    @staticmethod
+    def _is_link_to(location, target):
+        return os.path.islink(location) and os.readlink(location) == target
+
+    @staticmethod
+    def _is_hard_link_to(location, target):
+        return os.path.lexists(location) \
+            and not os.path.islink(location) \
+            and os.path.exists(target) \
+            and os.path.samefile(location, target)
 
-    def _sow_regular(self, filename, ctxt):
+    def _sow_regular(self, filename, ctxt, in_memory):
         if self._content is not None:
             content = self._content
         else:
-            tpl = Template(self._template, searchList=[ctxt.env])
+            cache_dir = getattr(ctxt.args, 'template_cache', None)
+            tpl = TemplateCache().template(self._template, ctxt.env, cache_dir)
             content = str(tpl)
-        def _file_sow():
-            # attempt to write to the file to get an IOError
-            # if that will fail.
-            # Naw, we should always be root and checking for
-            # writeable differs between file types as well as
-            # where they are in the tree. Do this later when we
-            # determine that it is needed. 2010-12-13 Aaron
-            #open(self.location, 'ab').close()
-            with open(filename, 'w') as output:
-                output.write(content)
-        ctxt.es.work(_file_sow)
+        threshold = getattr(
+            ctxt.args, 'memory_threshold', File.MEMORY_THRESHOLD)
+        if in_memory and len(content) <= threshold:
+            ctxt.sown[filename] = content
+            return
+        ctxt.sown.pop(filename, None)
+        ctxt.es.work(_sow_content, filename, content)
 
     def _sow_dir(self, filename, ctxt):
         ctxt.es.mkdir(filename)
         for node in self._files:
-            node.sow(node.location, ctxt)
+            node_filename = os.path.join(
+                filename, os.path.basename(node.location))
+            node.sow(node_filename, ctxt, in_memory=False)
+
+    def _sow_sym(self, filename, ctxt):
+        ctxt.es.work(_sow_link, self._target, filename)
 
     def _load_config(self, config, source, location):
         self.location = location
         self.owner = config.get('owner', None)#'root')
         self.group = config.get('group', None)#'root')
         self.mode = config.get('mode', None)#'u=rw,go=r')
-
         # make sure there is only 1 type.
         markers = set(['template', 'content', 'target', 'absent', 'files'])
         keys = set(config.keys())
@@ -242,15 +494,14 @@ class File(object):
         except KeyError:
             self.type = File.IS.regular
             self._content = ''
+            self._compile_mode()
             return self
         if cat == 'template':
             self.type = File.IS.regular
-            with source.open(source.path_to_content(config[cat])) as rep_file:
-                self._template = rep_file.read()
+            self._template = source.read(source.path_to_content(config[cat]))
         elif cat == 'content':
             self.type = File.IS.regular
-            with source.open(source.path_to_content(config[cat])) as rep_file:
-                self._content = rep_file.read()
+            self._content = source.read(source.path_to_content(config[cat]))
         elif cat == 'files':
             self.type = File.IS.dir
             self._load_dir(config, source)
@@ -265,6 +516,7 @@ class File(object):
         else:
             msg = 'Unable to infer file type: {0}'
             raise RuntimeError, msg.format(location)
+        self._compile_mode()
         return self
 
     def _load_dir(self, config, source):
@@ -275,66 +527,466 @@ class File(object):
                 raise BadFilename, "File in directory cannot contain '/'."
             location = os.path.join(self.location, sub)
             if isinstance(node, basestring):
-                with source.open(source.path_to_file(node)) as file_def:
-                    file_config = yaml.load(file_def.read())
+                file_config = source.load(source.path_to_file(node))
                 vvfile = File()._load_config(file_config, source, location)
             else:
                 vvfile = File()._load_config(node, source, location)
             self._files.append(vvfile)
 
-    @staticmethod
-    def _is_int(mode_string):
+    def _compile_mode(self):
+        if self.mode is None:
+            return
         try:
-            int(mode_string)
-            return True
-        except ValueError:
-            pass
-        return False
+            if isinstance(self.mode, (int, long)):
+                # Only a mode given as a number rather than read from
+                # yaml, which keeps modes as they were written.
+                if not 0 <= self.mode <= File.ALL_MODE_BITS:
+                    raise BadMode, oct(self.mode)
+                self.mode_bits = self.mode
+                self.mode_mask = File.ALL_MODE_BITS
+            else:
+                self.mode_bits, self.mode_mask = File._parse_mode(
+                    str(self.mode), self.type == File.IS.dir)
+        except BadMode, e:
+            msg = "Bad mode for '{0}': {1}"
+            raise BadMode, msg.format(self.location, e)
 
     @staticmethod
-    def _parse_mode(mode_string):
-        modes = mode_string.split(',')
-        mode_bits = 0
-        for mode in modes:
-            affected, value = mode.split('=')
-            mask = 0
-            if 'u' in affected: mask |= 0b100111000000
-            if 'g' in affected: mask |= 0b010000111000
-            if 'o' in affected: mask |= 0b001000000111
-            if 'a' in affected: mask |= 0b111111111111
-            perm = 0
-            if 'r' in value: perm |= 0b000100100100
-            if 'w' in value: perm |= 0b000010010010
-            if 'x' in value: perm |= 0b000001001001
-            if 's' in value: perm |= 0b111000000000
-            mode_bits |= (mask & perm)
-        return mode_bits
-
-    def _uid_gid_owner(self):
+    def _parse_mode(mode_string, is_dir=False):
+        """
+        Parse an octal or chmod style symbolic mode into the pair of
+        the permission bits and the mask of bits which the mode sets.
+        A mode which only uses ``=`` is absolute and sets every bit,
+        eg ``u=rw`` is 0600. Once any clause uses ``+`` or ``-`` the
+        bits outside the mask are left as they are on the host, eg
+        ``u+x`` only sets the user execute bit.
+
+        Symbolic modes are comma separated clauses of who (``ugoa``)
+        followed by one or more operators (``+-=``) each with either
+        permissions (``rwxXst``) or a class to copy from (``ugo``).
+        No who means ``a``; the umask is not consulted. ``X`` sets
+        execute on directories or where an earlier clause set some
+        execute bit.
+        """
+        if not mode_string:
+            raise BadMode, 'empty mode'
+        if mode_string.isdigit():
+            # A leading 0 may mark the mode as octal, eg 04755.
+            digits = mode_string.lstrip('0')
+            if len(digits) > 4 or '8' in digits or '9' in digits:
+                raise BadMode, mode_string
+            return int(mode_string, 8), File.ALL_MODE_BITS
+        bits = 0
+        mask = 0
+        relative = False
+        for clause in mode_string.split(','):
+            pos = 0
+            who = 0
+            while pos < len(clause) and clause[pos] in File._WHO_BITS:
+                who |= File._WHO_BITS[clause[pos]]
+                pos += 1
+            if who == 0:
+                who = File._WHO_BITS['a']
+            if pos == len(clause):
+                raise BadMode, "no operator in '{0}'".format(clause)
+            while pos < len(clause):
+                op = clause[pos]
+                if op not in '+-=':
+                    msg = "unexpected '{0}' in '{1}'"
+                    raise BadMode, msg.format(op, clause)
+                pos += 1
+                perm = 0
+                if pos < len(clause) and clause[pos] in File._CLASS_SHIFT:
+                    source = File._CLASS_SHIFT[clause[pos]]
+                    if (mask >> source) & 07 != 07:
+                        msg = "cannot copy unset permissions in '{0}'"
+                        raise BadMode, msg.format(clause)
+                    perm = ((bits >> source) & 07) * 0111
+                    pos += 1
+                else:
+                    while pos < len(clause) and clause[pos] in 'rwxXst':
+                        char = clause[pos]
+                        if char == 'X':
+                            if is_dir or bits & mask & 0111:
+                                perm |= File._PERM_BITS['x']
+                        else:
+                            perm |= File._PERM_BITS[char]
+                        pos += 1
+                perm &= who
+                if op == '=':
+                    bits = (bits & ~who) | perm
+                    mask |= who
+                elif op == '+':
+                    bits |= perm
+                    mask |= perm
+                    relative = True
+                else:
+                    bits &= ~perm
+                    mask |= perm
+                    relative = True
+        if not relative:
+            return bits & mask, File.ALL_MODE_BITS
+        return bits & mask, mask
+
+    def _uid_gid_owner(self, owners):
         uid = -1
         gid = -1
         if self.owner is not None:
-            uid = pwd.getpwnam(self.owner)[2]
+            uid = owners.uid(self.owner)
         if self.group is not None:
-            gid = grp.getgrnam(self.group)[2]
+            gid = owners.gid(self.group)
         return uid, gid
 
-    def _file_mode(self):
-        mode = None
-        if self.mode is not None:
-            if File._is_int(self.mode):
-                mode = string.atoi(self.mode, base=8)
-            else:
-                mode = File._parse_mode(self.mode)
-        return mode
+    def _names(self):
+        "Returns the sets of owner and group names used by this tree."
+        owners = set()
+        groups = set()
+        if self.owner is not None:
+            owners.add(self.owner)
+        if self.group is not None:
+            groups.add(self.group)
+        for node in self._files or []:
+            node_owners, node_groups = node._names()
+            owners.update(node_owners)
+            groups.update(node_groups)
+        return owners, groups
+
+    def check_owners(self, ctxt):
+        """
+        Raise UnknownOwnerError unless every owner and group in this
+        tree exists in the environment.
+        """
+        owners, groups = self._names()
+        ctxt.es.work(_validate_owners, ctxt.owners, owners, groups)
+
+    def _file_mode(self, location=None):
+        """
+        Returns the mode to give the node at ``location``, which is
+        only looked at when the mode leaves some bits unchanged.
+        """
+        if self.mode_bits is None:
+            return None
+        if self.mode_mask == File.ALL_MODE_BITS:
+            return self.mode_bits
+        current = stat.S_IMODE(os.lstat(location).st_mode)
+        return (current & ~self.mode_mask) | self.mode_bits
+
+def _plant_node(vvfile, src_filename, dst_filename, content, converge,
+                owners):
+    """
+    Does the work of ``File.plant`` inside the environment. Regular
+    file ``content`` which was sown in memory is planted in place of
+    ``src_filename``.
+    """
+    counts = [0, 0]
+    def _tally(changed):
+        counts[0 if changed else 1] += 1
+    def _remove(name):
+        if os.path.islink(name) or os.path.isfile(name):
+            os.unlink(name)
+        elif os.path.isdir(name):
+            shutil.rmtree(name)
+        elif os.path.exists(name):
+            msg = "Path is unknown type: {0}"
+            raise RuntimeError, msg.format(name)
+    def _needs(location, uid, gid, mode):
+        if not converge:
+            return uid > -1 or gid > -1, mode is not None
+        st = os.lstat(location)
+        chown = (uid > -1 and st.st_uid != uid) or \
+            (gid > -1 and st.st_gid != gid)
+        chmod = mode is not None and stat.S_IMODE(st.st_mode) != mode
+        return chown, chmod
+    def _finalize_file(location, uid, gid, mode):
+        # print("finalize file {0}".format(location))
+        chown, chmod = _needs(location, uid, gid, mode)
+        if chown:
+            os.chown(location, uid, gid)
+        if chmod:
+            os.chmod(location, mode)
+        return chown or chmod
+    def _finalize_link(location, uid, gid, mode):
+        # print("finalize link {0}".format(location))
+        chown, chmod = _needs(location, uid, gid, mode)
+        if chown:
+            os.lchown(location, uid, gid)
+        # Not every platform can change the mode of a link.
+        chmod = chmod and hasattr(os, 'lchmod')
+        if chmod:
+            os.lchmod(location, mode)
+        return chown or chmod
+    def _sync(node, src_fname, dst_fname, force):
+        # Reconcile dst_fname with what was sown in src_fname,
+        # touching only the entries which differ. Every entry is
+        # replaced by renaming over it so it is never missing.
+        uid, gid = node._uid_gid_owner(owners)
+        changed = False
+        if node.type == File.IS.regular:
+            if node is vvfile and content is not None:
+                if force or not File._holds(dst_fname, content):
+                    File._write_file(content, dst_fname)
+                    changed = True
+            elif force or not node._matches(src_fname, dst_fname):
+                File._replace_file(src_fname, dst_fname)
+                changed = True
+        elif node.type == File.IS.dir:
+            if os.path.islink(dst_fname) or not os.path.isdir(dst_fname):
+                _remove(dst_fname)
+                os.mkdir(dst_fname)
+                changed = True
+            wanted = set(os.path.basename(child.location)
+                         for child in node._files
+                         if child.type != File.IS.absent)
+            for name in os.listdir(dst_fname):
+                if name not in wanted:
+                    _remove(os.path.join(dst_fname, name))
+                    changed = True
+            for child in node._files:
+                name = os.path.basename(child.location)
+                _sync(child, os.path.join(src_fname, name),
+                      os.path.join(dst_fname, name), False)
+        elif node.type == File.IS.sym:
+            if not File._is_link_to(dst_fname, node._target):
+                File._replace_link(os.symlink, node._target, dst_fname)
+                changed = True
+        elif node.type == File.IS.hard:
+            if not File._is_hard_link_to(dst_fname, node._target):
+                File._replace_link(os.link, node._target, dst_fname)
+                changed = True
+        elif node.type == File.IS.absent:
+            changed = os.path.lexists(dst_fname)
+            _remove(dst_fname)
+        if node.type in (File.IS.regular, File.IS.dir):
+            mode = node._file_mode(dst_fname)
+            changed = _finalize_file(dst_fname, uid, gid, mode) or changed
+        elif node.type in (File.IS.sym, File.IS.hard):
+            mode = node._file_mode(dst_fname)
+            changed = _finalize_link(dst_fname, uid, gid, mode) or changed
+        _tally(changed)
+    # Resolve every name before anything is changed.
+    owners.validate(*vvfile._names())
+    _sync(vvfile, src_filename, dst_filename, not converge)
+    return tuple(counts)
+
+def _sow_content(filename, content):
+    # attempt to write to the file to get an IOError
+    # if that will fail.
+    # Naw, we should always be root and checking for
+    # writeable differs between file types as well as
+    # where they are in the tree. Do this later when we
+    # determine that it is needed. 2010-12-13 Aaron
+    #open(self.location, 'ab').close()
+    with open(filename, 'w') as output:
+        output.write(content)
+
+def _sow_link(target, filename):
+    if os.path.lexists(filename):
+        os.unlink(filename)
+    os.symlink(target, filename)
+
+class Owners(object):
+    """
+    Cache of owner and group names resolved to ids in one environment.
+    Call ``invalidate`` after anything, such as installing packages,
+    which may add users or groups. Lookups must be made from inside
+    the environment, ie from ``es.work``.
+    """
+    def __init__(self):
+        self._uids = {}
+        self._gids = {}
+
+    def uid(self, name):
+        try:
+            return self._uids[name]
+        except KeyError:
+            pass
+        uid = pwd.getpwnam(name).pw_uid
+        self._uids[name] = uid
+        return uid
+
+    def gid(self, name):
+        try:
+            return self._gids[name]
+        except KeyError:
+            pass
+        gid = grp.getgrnam(name).gr_gid
+        self._gids[name] = gid
+        return gid
+
+    def invalidate(self):
+        self._uids = {}
+        self._gids = {}
+
+    def validate(self, owners, groups):
+        unknown = []
+        for name in sorted(owners):
+            try:
+                self.uid(name)
+            except KeyError:
+                unknown.append('owner ' + name)
+        for name in sorted(groups):
+            try:
+                self.gid(name)
+            except KeyError:
+                unknown.append('group ' + name)
+        if unknown:
+            msg = "Unknown {0}"
+            raise UnknownOwnerError, msg.format(', '.join(unknown))
+
+def _validate_owners(owners, owner_names, group_names):
+    owners.validate(owner_names, group_names)
+
+def _invalidate_owners(owners):
+    owners.invalidate()
+
+class TemplateCache(object):
+    """
+    Process wide cache of compiled Cheetah template classes keyed by
+    the digest of the template source so that each distinct template
+    is compiled once no matter how many files or hosts render it.
+
+    When a ``cache_dir`` is given the generated python module for each
+    template is also kept there and reused by later processes. Since
+    a cached module is executed it is only reused if it was written
+    by this user, is not writable by anyone else and names the same
+    source and Cheetah version.
+    """
+    __shared_state = {}
+    def __init__(self):
+        self.__dict__ = TemplateCache.__shared_state
+        if not hasattr(self, '_initialized'):
+            self._classes = {}
+            self._initialized = True
+
+    def template(self, source, env, cache_dir=None):
+        return self.template_class(source, cache_dir)(searchList=[env])
+
+    def template_class(self, source, cache_dir=None):
+        if isinstance(source, unicode):
+            digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        else:
+            digest = hashlib.sha1(source).hexdigest()
+        if digest not in self._classes:
+            self._classes[digest] = self._compile(source, digest, cache_dir)
+        return self._classes[digest]
+
+    @staticmethod
+    def _compile(source, digest, cache_dir):
+        class_name = 'template_{0}'.format(digest)
+        if cache_dir is None:
+            return Template.compile(source=source, className=class_name)
+        filename = os.path.join(cache_dir, class_name + '.py')
+        header = TemplateCache._header(source)
+        code = TemplateCache._load(filename, header)
+        if code is None:
+            code = header + Template.compile(
+                source=source,
+                className=class_name,
+                moduleName=class_name,
+                returnAClass=False)
+            safeio.write_atomically(filename, code, 0600)
+        module = types.ModuleType(class_name)
+        module.__file__ = filename
+        exec compile(code, filename, 'exec') in module.__dict__
+        # Keep the module alive, otherwise python clears its globals
+        # out from under the template class.
+        sys.modules[class_name] = module
+        return getattr(module, class_name)
+
+    @staticmethod
+    def _header(source):
+        "The first line of a cached module, naming what it came from."
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        return '# vivarium template {0} cheetah {1}\n'.format(
+            hashlib.sha256(source).hexdigest(), CheetahVersion)
+
+    @staticmethod
+    def _load(filename, header):
+        """
+        Returns the code of the cached module ``filename`` or ``None``
+        if it is missing, untrusted or does not start with ``header``.
+        """
+        module_file = safeio.open_private(filename)
+        if module_file is None:
+            return None
+        with module_file:
+            code = module_file.read()
+        if not code.startswith(header):
+            return None
+        return code
+
+class BlobStore(object):
+    """
+    File bodies referenced from seeds by digest. Each body is read
+    from the ``/blobs`` section of ``spawn`` only when it is not
+    already in ``cache_dir``, where it is then kept for later plants.
+    Bodies are not kept in memory so they can be let go along with
+    the steps of each target once it is planted.
+    """
+    def __init__(self, spawn, cache_dir=None):
+        self.spawn = spawn
+        self.cache_dir = cache_dir
+
+    def get(self, digest):
+        if self.cache_dir is not None:
+            filename = os.path.join(self.cache_dir, digest)
+            try:
+                with open(filename, 'rb') as cached:
+                    body = cached.read()
+                if hashlib.sha256(body).hexdigest() == digest:
+                    return body
+            except IOError as exc:
+                if exc.errno != errno.ENOENT: raise
+        body = self.spawn.read(self.spawn.path_to_blob(digest))
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if hashlib.sha256(body).hexdigest() != digest:
+            raise BlobError, "Corrupt blob in spawn: {0}".format(digest)
+        if self.cache_dir is not None:
+            safeio.write_atomically(filename, body, 0600)
+        return body
+
+class PlantJournal(object):
+    """
+    Record of the targets planted on a host, each with the digest of
+    its seed entry and env, kept in ``filename`` so a later plant can
+    skip targets which are already planted as they are. The journal
+    is rewritten as each target finishes so it survives a plant which
+    dies part way.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as journal:
+                self._planted = yamlio.load(journal) or {}
+        except IOError as exc:
+            if exc.errno != errno.ENOENT: raise
+            self._planted = {}
+
+    def is_planted(self, name, digest):
+        return digest is not None and self._planted.get(name) == digest
+
+    def record(self, name, digest):
+        if digest is None:
+            return
+        self._planted[name] = digest
+        self._store()
+
+    def forget(self, names):
+        for name in names:
+            self._planted.pop(name, None)
+        self._store()
+
+    def _store(self):
+        safeio.write_atomically(self.filename, yamlio.dump(self._planted))
 
 class Role(Entity):
     def __init__(self, *args, **kwargs):
         super(Role, self).__init__(*args, **kwargs)
 
     def from_source(self, source):
-        with source.open(source.path_to_role(self.name)) as configfile:
-            self._load_config(source, configfile)
+        self._load_config(source, source.path_to_role(self.name))
         return self
 
     def to_seed(self):
@@ -380,11 +1032,14 @@ class Host(Entity):
         super(Host, self).__init__(*args, **kwargs)
         self.roles = {}
         self.stages = []
+        # The PlantJournal while planting and the digest of each
+        # target being planted.
+        self._journal = None
+        self._digests = {}
 
     def from_source(self, source):
-        with source.open(source.path_to_host(self.name)) as configfile:
-            self._load_config(source, configfile)
-            self._load_roles(source)
+        self._load_config(source, source.path_to_host(self.name))
+        self._load_roles(source)
         self._gather(source)
         return self
 
@@ -405,17 +1060,22 @@ class Host(Entity):
         seed['stages'] = stages
         return seed
 
-    def from_spawn(self, spawn):
-        with spawn.open(spawn.path_to_seed(self.name)) as definition:
-            config = yaml.load(definition.read())
+    def from_spawn(self, spawn, blobs=None):
+        # A binary seed is left in the mapped file and only the steps
+        # of a target about to be planted are decoded.
+        data = spawn.map(spawn.path_to_seed(self.name))
+        config = seedfile.load(data, lazy=True)
         if self.name != config['name']:
             msg = 'Found definition for {0} when loading {1}.'
             raise HostMismatch, msg.format(config['name'], self.name)
-        self._config = config['config']
+        if blobs is None:
+            blobs = BlobStore(spawn)
+        self._config = seedfile.thaw(config['config'])
         for rolename, value in config.get('roles', {}).iteritems():
             generic_role = Role(name=rolename)
-            generic_role._config = value['role']['config']
-            role_spec = Host.RoleSpec(value['config'], generic_role)
+            generic_role._config = seedfile.thaw(value['role']['config'])
+            role_spec = Host.RoleSpec(
+                seedfile.thaw(value['config']), generic_role)
             self.roles[rolename] = role_spec
         self.stages = []
         for stage in config['stages']:
@@ -423,19 +1083,255 @@ class Host(Entity):
             for name, value in stage.iteritems():
                 target = Target().from_spawn(
                     value['steps'],
-                    value['depends'],
-                    value['env'])
+                    seedfile.thaw(value['depends']),
+                    seedfile.thaw(value['env']),
+                    blobs)
                 targets[name] = target
             self.stages.append(targets)
         return self
 
     def plant(self, es, default_env, args):
+        # Merge the env of every target up front so that targets with
+        # the same env share it.
+        envs = {}
+        for stage in self.stages:
+            for target in stage.itervalues():
+                target.merged_env(default_env, envs)
+        if getattr(args, 'stage_dir', None) is not None:
+            self._journal = PlantJournal(self._journal_filename(args))
+            self._skip_planted(default_env, getattr(args, 'force', False))
+        jobs = getattr(args, 'jobs', 1) or 1
+        critical_path = getattr(args, 'schedule', None) == 'critical-path'
+        pool = None
+        output = None
+        if jobs > 1 or critical_path:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            output = _BufferedOutput(sys.stdout)
+            sys.stdout = output
+        try:
+            if critical_path:
+                self._plant_critical_path(
+                    pool, output, es, default_env, args)
+            else:
+                self._plant_stages(pool, output, es, default_env, args)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                sys.stdout = output.stream
+
+    def select_targets(self, names, dependents=False):
+        """
+        Keep only the targets in ``names`` and every target they
+        depend on, and when ``dependents`` is true every target which
+        depends on them too. Targets stay in the stages they were in so
+        the order they are planted in is unchanged.
+        """
+        targets = {}
+        for stage in self.stages:
+            targets.update(stage)
+        unknown = sorted(set(names) - set(targets))
+        if unknown:
+            msg = "No such targets in {0}: {1}"
+            raise UnknownTargetError, msg.format(
+                self.name, ', '.join(unknown))
+        deps = {}
+        for name, target in targets.iteritems():
+            deps[name] = set(dep for dep in target.depends or []
+                             if dep in targets)
+        selected = _closure(names, deps)
+        if dependents:
+            reverse = dict((name, set()) for name in targets)
+            for name, depends in deps.iteritems():
+                for dep in depends:
+                    reverse[dep].add(name)
+            selected.update(_closure(names, reverse))
+        stages = []
+        for stage in self.stages:
+            kept = dict((name, target)
+                        for name, target in stage.iteritems()
+                        if name in selected)
+            if kept:
+                stages.append(kept)
+        self.stages = stages
+        return self
+
+    def _skip_planted(self, default_env, force):
+        """
+        Leave out of the stages every target which the journal shows
+        was already planted from the same seed entry and env, unless
+        ``force``. The rest are dropped from the journal until they are
+        planted again.
+        """
+        self._digests = {}
+        for stage in self.stages:
+            for name, target in stage.items():
+                digest = target.digest(target.merged_env(default_env))
+                if not force and self._journal.is_planted(name, digest):
+                    print("Target: {0} already planted".format(name))
+                    del stage[name]
+                else:
+                    self._digests[name] = digest
+        self._journal.forget(self._digests.keys())
+
+    def _planted(self, name):
+        if self._journal is not None:
+            self._journal.record(name, self._digests[name])
+
+    def _journal_filename(self, args):
+        return _stage_filename(args, '{0}.journal'.format(self.name))
+
+    def _plant_stages(self, pool, output, es, default_env, args):
         for count, stage in enumerate(self.stages):
             print("Stage {0}".format(count))
             print("********")
+            Host._prepare_stage(stage, es)
+            if pool is not None and len(stage) > 1:
+                self._plant_stage(pool, output, stage, es, default_env, args)
+                continue
             for name, target in stage.iteritems():
                 print("Target: {0}".format(name))
-                target.plant(name, es, default_env, args)
+                if target.plant(name, es, default_env, args) is not False:
+                    self._planted(name)
+
+    @staticmethod
+    def _prepare_stage(stage, es):
+        "Give each action one look at all of its steps in ``stage``."
+        steps = {}
+        for name in sorted(stage):
+            for step in stage[name].steps:
+                steps.setdefault(step.action_name, []).append(step)
+        for action_name in sorted(steps):
+            action_steps = steps[action_name]
+            action_steps[0].action_impl.prepare(es, action_steps)
+
+    def _plant_stage(self, pool, output, stage, es, default_env, args):
+        """
+        Plant every target in ``stage`` on ``pool`` and wait for all
+        of them. The output of each target is buffered and written in
+        one piece once the stage is done. If any target fails the
+        first failure is raised after the rest of the stage finishes.
+        """
+        def plant_target(item):
+            name, target = item
+            return Host._plant_target(
+                output, name, target, es, default_env, args)
+        results = pool.map(plant_target, sorted(stage.iteritems()))
+        errors = []
+        for name, text, error, elapsed, complete in results:
+            output.write(text)
+            if error is not None:
+                errors.append(error)
+            elif complete:
+                self._planted(name)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _plant_critical_path(self, pool, output, es, default_env, args):
+        """
+        Plant every target as soon as the targets it depends on are
+        done rather than waiting for a whole stage. When more targets
+        are ready than there are workers, the target with the longest
+        chain of work after it goes first, using the time each target
+        took the last time this host was planted.
+
+        If a target fails nothing new is started and the first failure
+        is raised once the running targets finish.
+        """
+        targets = {}
+        for stage in self.stages:
+            targets.update(stage)
+        deps = {}
+        for name, target in targets.iteritems():
+            deps[name] = set(dep for dep in target.depends or []
+                             if dep in targets and dep != name)
+        durations = self._load_durations(args)
+        priority, dependents = _critical_path(deps, durations)
+        waiting = deepcopy(deps)
+        jobs = getattr(args, 'jobs', 1) or 1
+        ready = [(-priority[name], name)
+                 for name, depends in waiting.iteritems() if not depends]
+        heapq.heapify(ready)
+        done = Queue.Queue()
+        running = 0
+        errors = []
+        try:
+            while running or (ready and not errors):
+                while ready and not errors and running < jobs:
+                    name = heapq.heappop(ready)[1]
+                    # Targets start on their own rather than as part
+                    # of a stage so each is prepared on its own.
+                    pool.apply_async(
+                        Host._plant_target,
+                        (output, name, targets[name], es, default_env, args,
+                         True),
+                        callback=done.put)
+                    running += 1
+                name, text, error, elapsed, complete = done.get()
+                running -= 1
+                output.write(text)
+                if error is not None:
+                    errors.append(error)
+                    continue
+                if complete:
+                    self._planted(name)
+                durations[name] = elapsed
+                for dependent in dependents[name]:
+                    waiting[dependent].discard(name)
+                    if not waiting[dependent]:
+                        item = (-priority[dependent], dependent)
+                        heapq.heappush(ready, item)
+        finally:
+            self._store_durations(args, durations)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    @staticmethod
+    def _plant_target(output, name, target, es, default_env, args,
+                      prepare=False):
+        """
+        Plant a single target with its output buffered, first giving
+        its actions a look at its steps if ``prepare``. Returns
+        ``(name, output, error, elapsed, complete)`` where error is the
+        ``sys.exc_info()`` of a failure or ``None`` and complete is
+        false if the target reported some of its work undone.
+        """
+        error = None
+        complete = False
+        start = time.time()
+        with output.capture() as buffered:
+            # Catch everything. The critical-path scheduler waits for
+            # this result, so anything escaping would hang it for good.
+            try:
+                print("Target: {0}".format(name))
+                if prepare:
+                    Host._prepare_stage({name: target}, es)
+                planted = target.plant(name, es, default_env, args)
+                complete = planted is not False
+            except BaseException:
+                error = sys.exc_info()
+        elapsed = time.time() - start
+        return name, buffered.getvalue(), error, elapsed, complete
+
+    def _durations_filename(self, args):
+        return _stage_filename(args, '{0}.durations'.format(self.name))
+
+    def _load_durations(self, args):
+        try:
+            with open(self._durations_filename(args)) as durations:
+                return yamlio.load(durations) or {}
+        except IOError as exc:
+            if exc.errno == errno.ENOENT: return {}
+            else: raise
+
+    def _store_durations(self, args, durations):
+        # Durations only order later plants so failing to keep them
+        # must not hide whatever happened while planting.
+        try:
+            safeio.write_atomically(
+                self._durations_filename(args), yamlio.dump(durations))
+        except (IOError, OSError) as exc:
+            print("Unable to store target durations: {0}".format(exc))
 
     def _gather(self, source):
         targets = self._find_targets(source)
@@ -484,10 +1380,12 @@ class Host(Entity):
         return stages
 
     def _load_roles(self, source):
-        roles = self._config.get('roles', [])
+        roles = self._config.get('roles', {})
         for name, spec in roles.iteritems():
             if spec is None: spec = {}
-            generic_role = Role(name=name).from_source(source)
+            generic_role = source.memoize(
+                ('role', name),
+                lambda: Role(name=name).from_source(source))
             role = Host.RoleSpec(spec, generic_role)
             self.roles[name] = role
 
@@ -511,11 +1409,28 @@ class Target(object):
         self.steps = []
         self.depends = []
         self.env = {}
+        # (default_env, merged env) from the last merged_env call.
+        self._merged = None
+
+    @property
+    def steps(self):
+        if self._steps is None:
+            self._steps = self._load_steps()
+        return self._steps
+
+    @steps.setter
+    def steps(self, steps):
+        self._steps = steps
+        # Seeds of the steps, and the store for their file bodies,
+        # when the steps are only decoded as they are needed.
+        self._step_seeds = None
+        self._blobs = None
 
     def from_source(self, source, steps, depends, env):
         self.steps = []
         self.depends = depends
         self.env = env
+        self._merged = None
         manager = ActionManager()
         for num, step in enumerate(steps):
             name = step['action']
@@ -527,19 +1442,29 @@ class Target(object):
             self.steps.append(the_step)
         return self
 
-    def from_spawn(self, steps, depends, env):
-        self.steps = []
+    def from_spawn(self, steps, depends, env, blobs=None):
+        self.steps = None
+        self._step_seeds = steps
+        self._blobs = blobs
         self.depends = depends
         self.env = env
+        self._merged = None
+        return self
+
+    def _load_steps(self):
+        steps = []
         manager = ActionManager()
-        for num, step in enumerate(steps):
+        for num, step in enumerate(self._step_seeds):
             name = step['action']
-            parameters = step['parameters']
-            data = step['data']
+            parameters = seedfile.thaw(step['parameters'])
+            data = seedfile.thaw(step['data'])
+            if self._blobs is not None:
+                for file_seed in _step_file_seeds(data):
+                    File.resolve_blobs(file_seed, self._blobs)
             action_impl = manager.action(name)
             the_step = Target.Step(num, name, action_impl, parameters, data)
-            self.steps.append(the_step)
-        return self
+            steps.append(the_step)
+        return steps
 
     def to_seed(self):
         seed = {}
@@ -551,8 +1476,48 @@ class Target(object):
         seed['env'] = self.env
         return seed
 
+    def merged_env(self, default_env, memo=None):
+        """
+        Returns the env of this target merged over ``default_env``.
+        The merge is done once and the read only result is shared by
+        every step. Targets given the same ``memo`` dict share one
+        result for equal envs.
+        """
+        if self._merged is not None and self._merged[0] is default_env:
+            return self._merged[1]
+        key = _freeze(self.env)
+        env = None
+        if memo is not None and key is not None:
+            env = memo.get(key, None)
+        if env is None:
+            env = _merge_dicts(default_env, self.env)
+            if memo is not None and key is not None:
+                memo[key] = env
+        self._merged = (default_env, env)
+        return env
+
+    def digest(self, env):
+        """
+        Returns a digest of the seed entry of this target together
+        with ``env``, or ``None`` if they cannot be digested. File
+        bodies held in a blob store count by their digest.
+        """
+        if self._step_seeds is not None:
+            seed = dict(
+                steps=seedfile.thaw(self._step_seeds),
+                depends=self.depends,
+                env=self.env)
+        else:
+            seed = self.to_seed()
+        frozen = _freeze((seed, env))
+        if frozen is None:
+            return None
+        return hashlib.sha1(repr(frozen)).hexdigest()
+
     def plant(self, target_name, es, default_env, args):
         contexts = []
+        stats = {}
+        env = self.merged_env(default_env)
         for num, step in enumerate(self.steps):
             context = ActionContext(
                 es,
@@ -560,8 +1525,9 @@ class Target(object):
                 num,
                 step.parameters,
                 step.data,
-                _merge_dicts(default_env, self.env),
-                args)
+                env,
+                args,
+                stats)
             contexts.append(context)
         sow = []
         for step, context in zip(self.steps, contexts):
@@ -572,11 +1538,24 @@ class Target(object):
         reap = []
         for step, context in zip(self.steps, contexts):
             reap.append(step.action_impl.reap(context))
+        if 'files_changed' in stats or 'files_unchanged' in stats:
+            msg = "Target {0}: {1} files changed, {2} unchanged"
+            print(msg.format(
+                target_name,
+                stats.get('files_changed', 0),
+                stats.get('files_unchanged', 0)))
+        if self._step_seeds is not None:
+            # Let the decoded steps and file bodies go. They are
+            # decoded again should they be needed.
+            self._steps = None
+        # Actions return False from a phase which left work undone.
+        return False not in sow + plant + reap
 
 def copy(args):
     source = humus.Humus(args.source)
     destination = humus.Humus(args.destination)
-    _recursive_copy('/', source, destination)
+    with destination.deferred():
+        _recursive_copy('/', source, destination)
 
 def _recursive_copy(directory, src, dst):
     dst.makedirs(directory)
@@ -591,30 +1570,193 @@ def _recursive_copy(directory, src, dst):
             _recursive_copy(node, src, dst)
 
 def seed(args):
-    spawn = humus.Humus(args.spawn)
+    spawn = humus.CachedHumus(args.spawn, lazy=True)
     if args.source is None: source = spawn
-    else: source = humus.Humus(args.source)
-    host = Host(name=args.host)
+    else: source = humus.CachedHumus(args.source, lazy=True)
+    hostnames = _seed_hostnames(source, args)
+    seed_format = getattr(args, 'seed_format', 'yaml')
+    if getattr(args, 'changed', False):
+        hostnames = [hostname for hostname in hostnames
+                     if _is_seed_stale(hostname, source, spawn, seed_format)]
+    jobs = min(getattr(args, 'jobs', 1) or 1, len(hostnames))
+    if jobs > 1:
+        results = _seed_in_pool(hostnames, source, args, jobs)
+    else:
+        results = (_seed_host(hostname, source, args)
+                   for hostname in hostnames)
+    # All writes happen here, in the parent, so that only a single
+    # writer ever touches the spawn.
+    failed = []
+    with spawn.deferred():
+        for hostname, result, inputs, blobs, error in results:
+            if error is not None:
+                msg = "Unable to seed host {0}:\n{1}"
+                print(msg.format(hostname, error))
+                failed.append(hostname)
+            elif args.stdout:
+                msg = "Configuration for {0}:".format(hostname)
+                print(msg)
+                print("="*len(msg))
+                import pprint
+                pprint.pprint(result)
+            else:
+                # Blobs are named by their content so one which is
+                # already in the spawn never needs writing again.
+                for digest, body in blobs.iteritems():
+                    blobname = spawn.path_to_blob(digest)
+                    if not _has_file(spawn, blobname):
+                        with spawn.open(blobname, 'w') as dest:
+                            dest.write(body)
+                seedname = spawn.path_to_seed(hostname)
+                with spawn.open(seedname, 'w') as dest:
+                    dest.write(result)
+                manifest = dict(
+                    format=seed_format, inputs=inputs, blobs=sorted(blobs))
+                manifestname = spawn.path_to_manifest(hostname)
+                with spawn.open(manifestname, 'w') as dest:
+                    dest.write(yamlio.dump(manifest))
+    if failed:
+        raise SeedError, failed
+
+def _seed_host(hostname, source, args):
+    """
+    Generate the seed for ``hostname``. Returns a tuple of
+    ``(hostname, result, inputs, blobs, error)`` where result is the
+    seed itself when emitting to stdout and the serialized seed
+    otherwise, inputs maps every source file read to its digest and
+    blobs maps the digest of every file body moved out of the
+    serialized seed to the body. Any failure is returned as a
+    formatted traceback in ``error`` so one bad host does not stop the
+    rest of a batch.
+    """
+    try:
+        with source.tracking() as inputs:
+            host = Host(name=hostname).from_source(source)
+        the_seed = host.to_seed()
+        if args.stdout:
+            return hostname, the_seed, inputs, {}, None
+        blobs = {}
+        for file_seed in _file_seeds(the_seed):
+            File.extract_blobs(file_seed, blobs)
+        seed_format = getattr(args, 'seed_format', 'yaml')
+        result = seedfile.dump(the_seed, seed_format)
+        return hostname, result, inputs, blobs, None
+    except Exception:
+        return hostname, None, None, None, traceback.format_exc()
+
+def _file_seeds(the_seed):
+    """
+    Yields the seed of every file installed by a step in ``the_seed``.
+    """
+    for stage in the_seed['stages']:
+        for target in stage.itervalues():
+            for step in target['steps']:
+                for file_seed in _step_file_seeds(step.get('data')):
+                    yield file_seed
+
+def _step_file_seeds(data):
+    "Returns the seed of every file in the ``data`` of a step."
+    files = (data or {}).get('files', None)
+    if _is_dict_like(files):
+        return files.values()
+    return []
+
+def _has_file(spawn, filename):
+    try:
+        return spawn.isfile(filename)
+    except IOError:
+        return False
+
+def _is_seed_stale(hostname, source, spawn, seed_format='yaml'):
+    """
+    Returns ``True`` unless the manifest recorded with the seed for
+    ``hostname`` shows it is in ``seed_format``, every source file it
+    was built from is unchanged and every blob it refers to is still
+    in the spawn.
+    """
     try:
-        host.from_source(source)
+        manifest = spawn.load(spawn.path_to_manifest(hostname))
+        if not spawn.isfile(spawn.path_to_seed(hostname)):
+            return True
     except IOError:
-        print("Unable to source host {0}".format(args.host))
+        return True
+    if not _is_dict_like(manifest) or \
+            manifest.get('format', None) != seed_format:
+        return True
+    for digest in manifest.get('blobs', None) or []:
+        if not _has_file(spawn, spawn.path_to_blob(digest)):
+            return True
+    for filename, digest in manifest.get('inputs', {}).iteritems():
+        try:
+            if source.digest(filename) != digest:
+                return True
+        except IOError:
+            return True
+    return False
+
+# The pool workers are forked after this is set so they inherit the
+# source along with everything the parent has already parsed from it.
+_seed_pool_state = {}
+
+def _seed_pool_worker(hostname):
+    source = _seed_pool_state['source']
+    args = _seed_pool_state['args']
+    return _seed_host(hostname, source, args)
+
+def _seed_in_pool(hostnames, source, args, jobs):
+    # Seed the first host before forking. That parses the roles,
+    # includes and contents most hosts share into the source cache so
+    # the workers inherit them instead of each parsing them again.
+    hostnames = list(hostnames)
+    if not hostnames:
+        return
+    yield _seed_host(hostnames[0], source, args)
+    hostnames = hostnames[1:]
+    if not hostnames:
+        return
+    _seed_pool_state['source'] = source
+    _seed_pool_state['args'] = args
+    pool = multiprocessing.Pool(min(jobs, len(hostnames)))
+    try:
+        for result in pool.imap_unordered(_seed_pool_worker, hostnames):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
         raise
-    the_seed = host.to_seed()
-    if args.stdout:
-        msg = "Configuration for {0}:".format(args.host)
-        print(msg)
-        print("="*len(msg))
-        import pprint
-        pprint.pprint(the_seed)
-    else:
-        serialized = yaml.dump(the_seed)
-        with spawn.open(spawn.path_to_seed(args.host), 'w') as dest:
-            dest.write(serialized)
+    finally:
+        pool.join()
+        _seed_pool_state.clear()
+
+def _seed_hostnames(source, args):
+    """
+    Return the list of hosts to seed. The host argument may name a
+    single host, be a shell style glob such as ``*.example.com``
+    matched against the ``/hosts`` section, or be ``@filename`` to
+    read a file with one host per line.
+    """
+    if args.host.startswith('@'):
+        with open(args.host[1:]) as hosts_file:
+            hostnames = [line.strip() for line in hosts_file]
+        return [name for name in hostnames
+                if name and not name.startswith('#')]
+    if _is_glob(args.host):
+        return fnmatch.filter(source.hosts(), args.host)
+    return [args.host]
+
+def _is_glob(name):
+    return any(char in name for char in '*?[')
 
 def plant(args):
-    spawn = humus.Humus(args.spawn)
-    host = Host(name=args.host).from_spawn(spawn)
+    spawn = humus.Humus(args.spawn, lazy=True)
+    blob_cache = getattr(args, 'blob_cache', None)
+    if blob_cache is None:
+        blob_cache = _stage_filename(args, 'blobs')
+    blobs = BlobStore(spawn, blob_cache)
+    host = Host(name=args.host).from_spawn(spawn, blobs)
+    if getattr(args, 'targets', None):
+        host.select_targets(
+            args.targets, getattr(args, 'with_dependents', False))
     es = Ecosystem().es(args=args)
     es.bootstrap()
     default_env = {'HOST' :
@@ -623,7 +1765,18 @@ def plant(args):
                     'DOMAIN': _domainname(args.host),
                     }
                    }
-    host.plant(es, default_env, args)
+    try:
+        host.plant(es, default_env, args)
+    finally:
+        es.close()
+
+def _stage_filename(args, name):
+    """
+    Returns the path of ``name`` in the stage dir as seen from outside
+    the root. Like the rest of the stage dir it is inside ``root_dir``.
+    """
+    root_dir = getattr(args, 'root_dir', None) or '/'
+    return os.path.join(root_dir, args.stage_dir.lstrip('/'), name)
 
 def _shortname(name):
     if '.' not in name: return name
@@ -646,6 +1799,96 @@ def _is_dict_like(obj, require_set=False):
     if hasattr(obj, 'keys') and hasattr(obj, '__getitem__'): return True
     else: return False
 
+class LayeredDict(collections.Mapping):
+    """
+    Read only view of dict-like layers stacked on one another, the
+    greatest first. A key takes its value from the greatest layer
+    which has it. When that value is dict-like it is itself layered
+    over the dict-like values for the same key in the lesser layers,
+    down to the first layer where the value is not dict-like.
+
+    Nothing is copied so building a view costs nothing and a lookup
+    only touches the layers it needs.
+    """
+    def __init__(self, layers):
+        self._layers = []
+        for layer in layers:
+            if isinstance(layer, LayeredDict):
+                self._layers.extend(layer._layers)
+            elif layer:
+                self._layers.append(layer)
+
+    def __getitem__(self, key):
+        found = []
+        for layer in self._layers:
+            if key not in layer:
+                continue
+            value = layer[key]
+            if not _is_dict_like(value):
+                if not found:
+                    return value
+                break
+            found.append(value)
+        if not found:
+            raise KeyError, key
+        if len(found) == 1 and isinstance(found[0], LayeredDict):
+            return found[0]
+        return LayeredDict(found)
+
+    def __contains__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return True
+        return False
+
+    def has_key(self, key):
+        return key in self
+
+    def __iter__(self):
+        seen = set()
+        for layer in self._layers:
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set(key for layer in self._layers for key in layer))
+
+    def __repr__(self):
+        return 'LayeredDict({0!r})'.format(dict(self.iteritems()))
+
+def _freeze(obj):
+    """
+    Returns a hashable equivalent of the plain data in ``obj`` for use
+    as a dict key, or ``None`` if it holds anything unhashable. Each
+    value is frozen along with its type, since python holds ``1``,
+    ``True`` and ``1.0`` equal, as it does ``'x'`` and ``u'x'``, but
+    a template renders them differently.
+    """
+    if _is_dict_like(obj):
+        items = []
+        for key in obj.keys():
+            frozen_key = _freeze(key)
+            value = _freeze(obj[key])
+            if frozen_key is None or value is None:
+                return None
+            items.append((frozen_key, value))
+        return ('dict', tuple(sorted(items)))
+    if isinstance(obj, (list, tuple)):
+        items = []
+        for item in obj:
+            value = _freeze(item)
+            if value is None:
+                return None
+            items.append(value)
+        return ('list', tuple(items))
+    try:
+        hash(obj)
+    except TypeError:
+        return None
+    return (type(obj).__name__, obj)
+
 def _safe_merge_dicts(lesser, greater):
     if lesser is None: return greater
     if greater is None: return lesser
@@ -657,20 +1900,51 @@ def _merge_dicts(lesser, greater):
     that all keys from both are in returned merged dictionary. In the
     case of conflict, the value-type for ``greater`` is chosen. The
     dict-like objects are not modified in the operation.
+
+    The result is a read only LayeredDict sharing its values with
+    ``lesser`` and ``greater``, so neither should be changed while it
+    is in use.
     """
-    dst = deepcopy(lesser)
-    stack = [(dst, greater)]
-    while stack:
-        ll, gg = stack.pop()
-        for key in gg:
-            if key not in ll:
-                ll[key] = deepcopy(gg[key])
-            else:
-                if _is_dict_like(gg[key]) and _is_dict_like(ll[key]):
-                    stack.append((ll[key], gg[key]))
-                else:
-                    ll[key] = deepcopy(gg[key])
-    return dst
+    return LayeredDict([greater, lesser])
+
+def _closure(names, edges):
+    """
+    Returns the set of ``names`` and everything reachable from them
+    through ``edges``, a dict of name to the set of names it leads to.
+    """
+    reached = set(names)
+    pending = list(names)
+    while pending:
+        for name in edges.get(pending.pop(), ()):
+            if name not in reached:
+                reached.add(name)
+                pending.append(name)
+    return reached
+
+def _critical_path(deps, durations):
+    """
+    Given ``deps`` as passed to ``_topological_sort`` and a dict of
+    the expected ``durations`` of some of the targets, return a tuple
+    of the priority of every target and the set of targets depending
+    on each target. The priority is the expected time from starting
+    the target to finishing everything which depends on it. Targets
+    without a known duration are expected to take the average time.
+    """
+    known = [durations[name] for name in deps if name in durations]
+    default = sum(known) / len(known) if known else 1.0
+    dependents = dict((name, set()) for name in deps)
+    for name, depends in deps.iteritems():
+        for dep in depends:
+            if dep != name:
+                dependents.setdefault(dep, set()).add(name)
+    # Sorting also checks for cycles.
+    layers = list(_topological_sort(deepcopy(deps)))
+    priority = {}
+    for layer in reversed(layers):
+        for name in layer:
+            after = [priority[dependent] for dependent in dependents[name]]
+            priority[name] = durations.get(name, default) + max(after or [0])
+    return priority, dependents
 
 def _topological_sort(deps):
     """
@@ -686,7 +1960,7 @@ def _topological_sort(deps):
     # Ignore self dependencies
     for k, v in deps.iteritems():
         v.discard(k)
-    extra_items_in_deps = reduce(set.union, deps.values()) - set(deps.keys())
+    extra_items_in_deps = reduce(set.union, deps.values(), set()) - set(deps.keys())
     deps.update(dict([(item, set()) for item in extra_items_in_deps]))
     while True:
         ordered = set(item for item,dep in deps.items() if not dep)
@@ -734,8 +2008,41 @@ def _find_plugins(path):
     sys.path.pop(0)
     return plugins
 
+class _BufferedOutput(object):
+    """
+    Stand-in for ``sys.stdout`` which sends whatever a thread writes
+    inside ``capture`` to a buffer for that thread, so the output of
+    targets planted at the same time does not interleave.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def write(self, data):
+        self._current().write(data)
+
+    def flush(self):
+        self._current().flush()
+
+    def is_capturing(self):
+        return getattr(self._local, 'buffer', None) is not None
+
+    @contextlib.contextmanager
+    def capture(self):
+        self._local.buffer = stringio.StringIO()
+        try:
+            yield self._local.buffer
+        finally:
+            self._local.buffer = None
+
+    def _current(self):
+        if self.is_capturing():
+            return self._local.buffer
+        return self.stream
+
 class ActionContext(object):
-    def __init__(self, es, target_name, num, params, data, env, args):
+    def __init__(self, es, target_name, num, params, data, env, args,
+                 stats=None):
         self.es = es
         self.target_name = target_name
         self.number = num
@@ -743,11 +2050,28 @@ class ActionContext(object):
         self.data = data
         self.env = env
         self.args = args
+        # Counters shared by every step of the target.
+        self.stats = stats if stats is not None else {}
+        # Content of small files sown in memory keyed by the filename
+        # they would have had in the stage dir.
+        self.sown = {}
+        self.owners = getattr(es, 'owners', None)
+        if self.owners is None:
+            self.owners = Owners()
 
 class Action(object):
     def gather(self, source, parameters, env):
         return {}
 
+    @classmethod
+    def prepare(cls, es, steps):
+        """
+        Called once per stage, before any target in the stage is
+        planted, with every ``Target.Step`` in the stage which uses
+        this action. Use it to batch work across targets.
+        """
+        pass
+
     def sow(self, context):
         return True
 
@@ -768,10 +2092,195 @@ class ActionManager(object):
     def action(self, name, *args, **kwargs):
         return self._actions[name](*args, **kwargs)
 
+def _run_command(command, capture):
+    if not capture:
+        return subprocess.call(command), None
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode, output
+
+class JailWorker(object):
+    """
+    Child processes which each chroot into ``root`` once and then run
+    the work sent to them over a pipe, so the parent process never
+    changes its own root. Each call goes to an idle child, so up to
+    ``size`` calls run at once, eg one for each plant thread.
+
+    Work is a module level function and its arguments, all of which
+    are pickled. The objects in ``resident`` are sent by name instead
+    and resolve to the child's own copy, so state such as a cache
+    lives on in the child from one call to the next. Use ``broadcast``
+    for work which updates that state.
+    """
+    class Child(object):
+        def __init__(self, pid, requests, replies, seen):
+            self.pid = pid
+            self.requests = requests
+            self.replies = replies
+            # How many broadcasts the child has run.
+            self.seen = seen
+
+    def __init__(self, root, resident=None, size=1):
+        self.root = root
+        self.size = size
+        self._resident = resident or {}
+        self._names = dict((id(obj), name)
+                           for name, obj in self._resident.iteritems())
+        self._lock = threading.Lock()
+        self._children = []
+        self._broadcasts = []
+        # Idle children, with None standing for one not yet forked.
+        self._idle = Queue.Queue()
+        for count in range(size):
+            self._idle.put(None)
+
+    def start(self):
+        "Fork the children. Best done before any other thread is started."
+        children = [self._idle.get() for count in range(self.size)]
+        for child in children:
+            self._idle.put(child or self._start())
+
+    def call(self, fn, *args, **kwargs):
+        "Returns ``fn(*args, **kwargs)`` as run by one of the children."
+        request = self._dumps((fn, args, kwargs))
+        child = self._idle.get()
+        try:
+            if child is None:
+                child = self._start()
+            with self._lock:
+                broadcasts = self._broadcasts[child.seen:]
+                child.seen = len(self._broadcasts)
+            for broadcast in broadcasts:
+                self._send(child, broadcast)
+            ok, value = self._send(child, request)
+        finally:
+            self._idle.put(child if child in self._children else None)
+        if not ok:
+            raise value
+        return value
+
+    def broadcast(self, fn, *args, **kwargs):
+        """
+        Have every child run ``fn(*args, **kwargs)`` before its next
+        call. Children forked later start from the parent's copy of
+        the resident objects, so they skip it.
+        """
+        request = self._dumps((fn, args, kwargs))
+        with self._lock:
+            self._broadcasts.append(request)
+
+    def close(self):
+        children = [self._idle.get() for count in range(self.size)]
+        for child in children:
+            if child is not None:
+                self._stop(child)
+            self._idle.put(None)
+
+    def _start(self):
+        requests_r, requests_w = os.pipe()
+        replies_r, replies_w = os.pipe()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(requests_w)
+                os.close(replies_r)
+                # Drop the ends of the other children's pipes, which
+                # would otherwise keep them from ever seeing EOF.
+                for other in self._children:
+                    os.close(other.requests.fileno())
+                    os.close(other.replies.fileno())
+                sys.stdout = sys.__stdout__
+                os.chroot(self.root)
+                os.chdir('/')
+                self._serve(os.fdopen(requests_r, 'rb'),
+                            os.fdopen(replies_w, 'wb'))
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        os.close(requests_r)
+        os.close(replies_w)
+        with self._lock:
+            child = JailWorker.Child(
+                pid,
+                os.fdopen(requests_w, 'wb'),
+                os.fdopen(replies_r, 'rb'),
+                len(self._broadcasts))
+            self._children.append(child)
+        return child
+
+    def _stop(self, child):
+        with self._lock:
+            self._children.remove(child)
+        for stream in [child.requests, child.replies]:
+            try:
+                stream.close()
+            except IOError:
+                pass
+        os.waitpid(child.pid, 0)
+
+    def _send(self, child, request):
+        """
+        Send the pickled ``request`` to ``child`` and return its
+        reply. A child which cannot be written to or whose reply
+        cannot be read is stopped, since it is either dead or its
+        pipes are out of step.
+        """
+        try:
+            child.requests.write(request)
+            child.requests.flush()
+            return self._load(child.replies)
+        except:
+            self._stop(child)
+            raise
+
+    def _serve(self, requests, replies):
+        while True:
+            try:
+                fn, args, kwargs = self._load(requests)
+            except EOFError:
+                return
+            try:
+                reply = (True, fn(*args, **kwargs))
+            except Exception, e:
+                reply = (False, e)
+            # Pickle the whole reply before writing any of it so a
+            # failure cannot leave part of one in the pipe.
+            try:
+                data = self._dumps(reply)
+            except Exception, e:
+                msg = "Unable to return result of {0}: {1}"
+                error = RuntimeError(msg.format(fn.__name__, e))
+                data = self._dumps((False, error))
+            replies.write(data)
+            replies.flush()
+
+    def _dumps(self, obj):
+        buffer = stringio.StringIO()
+        pickler = pickle.Pickler(buffer, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._persistent_id
+        pickler.dump(obj)
+        return buffer.getvalue()
+
+    def _load(self, stream):
+        unpickler = pickle.Unpickler(stream)
+        unpickler.persistent_load = self._resident.__getitem__
+        return unpickler.load()
+
+    def _persistent_id(self, obj):
+        return self._names.get(id(obj), None)
+
 class Environment(object):
     def __init__(self, *args, **kwargs):
         self.root = None
         self.args = kwargs.get('args', None)
+        self.owners = Owners()
         if self.args is not None:
             self.root = self.args.root_dir
             if not self.root.startswith('/'):
@@ -792,12 +2301,43 @@ class Environment(object):
     def install_package(self, package):
         raise NotImplementedError
 
+    def download_packages(self, packages):
+        """
+        Download all of ``packages``, returning a dict of package name
+        to ``True`` if that package was downloaded.
+        """
+        return dict((package, self.download_package(package) == 0)
+                    for package in packages)
+
+    def install_packages(self, packages):
+        """
+        Install all of ``packages``, returning a dict of package name
+        to ``True`` if that package was installed.
+        """
+        installed = self._install_packages(packages)
+        if installed:
+            # Packages may have added users or groups.
+            self.forget_owners()
+        return installed
+
+    def _install_packages(self, packages):
+        return dict((package, self.install_package(package) == 0)
+                    for package in packages)
+
     def run(self, command):
         raise NotImplementedError
 
     def work(self, callback, *args, **kwargs):
         raise NotImplementedError
 
+    def work_each(self, callback, *args, **kwargs):
+        """
+        Like ``work`` but for work which updates state kept inside the
+        environment, so it must reach every worker the environment
+        has rather than just one.
+        """
+        self.work(callback, *args, **kwargs)
+
     #
     # Utility methods
     #
@@ -810,6 +2350,31 @@ class Environment(object):
             if exc.errno == errno.EEXIST: pass
             else: raise
 
+    def call(self, command):
+        """
+        Run ``command`` like ``subprocess.call`` inside the
+        environment. While the output of the current target is being
+        buffered the output of the command is buffered along with it.
+        """
+        is_capturing = getattr(sys.stdout, 'is_capturing', None)
+        capture = is_capturing is not None and is_capturing()
+        returncode, output = self.work(_run_command, command, capture)
+        if output is not None:
+            sys.stdout.write(output)
+        return returncode
+
+    def forget_owners(self):
+        """
+        Drop every cached owner and group lookup, including those made
+        inside the environment. Call after adding users or groups.
+        """
+        self.owners.invalidate()
+        self.work_each(_invalidate_owners, self.owners)
+
+    def close(self):
+        "Release anything held for the environment once planting is done."
+        pass
+
     # def open(self, filename, mode):
     #     fullname = self._filename(filename)
     #     return open(fullname, mode)
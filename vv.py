@@ -3,8 +3,9 @@
 import argparse
 import os.path
 import sys
-import yaml
 
+import vivarium.humusfs.yamlio as yamlio
+import vivarium.seedfile as seedfile
 import vivarium.vivarium as vivarium
 
 def _config_parser(subparsers, defaults):
@@ -43,7 +44,10 @@ for the spawn.""")
     seed_parser.add_argument(
         'host',
         action='store',
-        help='Host to generate the seed.')
+        help="""
+Host to generate the seed. May be a glob such as '*.example.com' to
+seed every matching host in the source, or '@filename' to seed the
+hosts listed one per line in filename.""")
     seed_parser.add_argument(
         'spawn',
         action='store',
@@ -53,6 +57,28 @@ for the spawn.""")
         action='store',
         default=None,
         help='The source spawn to use if different from the spawn.')
+    seed_parser.add_argument(
+        '--changed',
+        action='store_true',
+        default=False,
+        help="""
+Only generate seeds for hosts whose roles, includes, files or contents
+changed since their seed was last generated.""")
+    seed_parser.add_argument(
+        '-j', '--jobs',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of processes used to generate seeds.')
+    seed_parser.add_argument(
+        '--format',
+        action='store',
+        dest='seed_format',
+        choices=seedfile.FORMATS,
+        default='yaml',
+        help="""
+Format to write seeds in. The binary format is quicker to plant from.
+Plant reads either.""")
     seed_parser.add_argument(
         '--stdout',
         action='store_true',
@@ -99,6 +125,78 @@ def _plant_parser(subparsers, defaults):
         action='store',
         default='/tmp',
         help='Directory for plant temporary files.')
+    plant_parser.add_argument(
+        '-j', '--jobs',
+        action='store',
+        type=int,
+        default=1,
+        help="""
+Number of targets in a stage to plant at the same time. Every target
+in a stage finishes before the next stage starts.""")
+    plant_parser.add_argument(
+        '--schedule',
+        action='store',
+        choices=['stages', 'critical-path'],
+        default='stages',
+        help="""
+How to order targets. With 'stages' every target in a stage finishes
+before the next stage starts. With 'critical-path' each target starts
+as soon as the targets it depends on finish, longest chains first.""")
+    plant_parser.add_argument(
+        '-t', '--target',
+        action='append',
+        dest='targets',
+        default=None,
+        metavar='NAME',
+        help="""
+Only plant the target NAME and the targets it depends on. May be given
+more than once. Targets are planted in the same stages as a full
+plant.""")
+    plant_parser.add_argument(
+        '--with-dependents',
+        action='store_true',
+        default=False,
+        help="""
+With --target, also plant every target which depends on the named
+targets.""")
+    plant_parser.add_argument(
+        '--force',
+        action='store_true',
+        default=False,
+        help="""
+Plant every target even if the journal in the stage dir shows it was
+already planted from the same seed and env.""")
+    plant_parser.add_argument(
+        '--converge',
+        action='store_true',
+        default=False,
+        help="""
+Leave files which already match the seed untouched, only changing
+content, ownership or permissions which differ.""")
+    plant_parser.add_argument(
+        '--template-cache',
+        action='store',
+        default=None,
+        help="""
+Directory to keep compiled templates in so later plants can skip
+compiling them. Templates are only cached in memory by default.""")
+    plant_parser.add_argument(
+        '--blob-cache',
+        action='store',
+        default=None,
+        help="""
+Directory to keep file bodies fetched from the spawn in so later
+plants only fetch bodies they have not seen. Defaults to 'blobs' in
+the stage dir.""")
+    plant_parser.add_argument(
+        '--memory-threshold',
+        action='store',
+        type=int,
+        default=vivarium.File.MEMORY_THRESHOLD,
+        metavar='BYTES',
+        help="""
+Keep files of up to BYTES in memory between sow and plant rather than
+writing them to the stage dir. Use 0 to stage every file.""")
     # plant_parser.add_argument(
     #     '--dry-run',
     #     action='store_true',
@@ -154,7 +252,7 @@ def _parse_arguments():
         help='Configuration file.')
     args = parser.parse_args()
     if os.path.exists(args.config_file):
-        defaults = yaml.load(open(args.config_file).read())
+        defaults = yamlio.load(open(args.config_file).read())
         parser = _initial_parser(defaults)
         args = parser.parse_args()
     return args